@@ -5,6 +5,11 @@ import json
 import sys
 import shutil
 import threading
+import atexit
+import hashlib
+import importlib
+import math
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from pathlib import Path
 import sqlite3
@@ -12,7 +17,7 @@ import logging
 from flask import (
     Flask, render_template, request, redirect, url_for, 
     flash, session, send_from_directory, send_file, jsonify, abort,
-    make_response
+    make_response, g, has_app_context, Response
 )
 import tempfile
 from flask_login import (
@@ -23,11 +28,17 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, SelectField
 from wtforms.validators import DataRequired, Length, EqualTo, Regexp
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+from sqlalchemy import (
+    create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Index, text,
+    select, insert, update, exists, and_, or_, true, func, literal, union_all, case
+)
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship, joinedload
+from sqlalchemy.exc import IntegrityError
 from markupsafe import escape, Markup
 import re
 import html
+import uuid
+from html.parser import HTMLParser
 from flask_cors import CORS
 from logging.handlers import RotatingFileHandler
 # 配置
@@ -123,15 +134,23 @@ class ChatRoom(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(64), unique=True)
     description = Column(Text)
+    message_seq = Column(Integer, default=0)  # 单调递增的消息序号，用于 O(1) 未读统计
 
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
+    __table_args__ = (
+        Index('ix_chat_messages_room_id_id', 'room_id', 'id'),
+        Index('ix_chat_messages_room_timestamp', 'room_id', 'timestamp'),
+        Index('ux_chat_messages_user_client', 'user_id', 'client_id', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     content = Column(Text)  # 只存储原始Markdown
     timestamp = Column(DateTime, index=True, default=datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.id'))
     room_id = Column(Integer, ForeignKey('chat_rooms.id'))
+    client_id = Column(String(64))  # 客户端生成的幂等键，(user_id, client_id) 唯一；重试发送返回已有消息
+    content_html = Column(Text)  # 服务端预渲染的 HTML（STORE_RENDERED_HTML 开启时保存），为空时按需渲染
     
     user = relationship('User', backref='chat_messages')
     room = relationship('ChatRoom', backref='messages')
@@ -142,6 +161,7 @@ class ForumSection(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(64), unique=True)
     description = Column(Text)
+    activity_seq = Column(Integer, default=0)  # 单调递增的主题+回复序号，用于 O(1) 未读统计
 
 class ForumThread(Base):
     __tablename__ = 'forum_threads'
@@ -152,6 +172,13 @@ class ForumThread(Base):
     timestamp = Column(DateTime, index=True, default=datetime.utcnow)
     user_id = Column(Integer, ForeignKey('users.id'))
     section_id = Column(Integer, ForeignKey('forum_sections.id'))
+    reply_count = Column(Integer, default=0)  # 冗余回复数，由发帖/删帖路径维护
+    last_reply_at = Column(DateTime)  # 最后回复时间；无回复时等于发帖时间，用于按最近活跃排序
+    
+    __table_args__ = (
+        Index('ix_forum_threads_section_timestamp', 'section_id', 'timestamp'),
+        Index('ix_forum_threads_section_last_reply', 'section_id', 'last_reply_at'),
+    )
     
     user = relationship('User', backref='forum_threads')
     section = relationship('ForumSection', backref='threads')
@@ -166,11 +193,18 @@ class ForumReply(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     thread_id = Column(Integer, ForeignKey('forum_threads.id'))
     
+    __table_args__ = (
+        Index('ix_forum_replies_thread_id_id', 'thread_id', 'id'),
+    )
+    
     user = relationship('User', backref='forum_replies')
 
 
 class ChatPermission(Base):
     __tablename__ = 'chat_permissions'
+    __table_args__ = (
+        Index('ux_chat_permissions_user_room', 'user_id', 'room_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -183,6 +217,9 @@ class ChatPermission(Base):
 
 class ForumPermission(Base):
     __tablename__ = 'forum_permissions'
+    __table_args__ = (
+        Index('ux_forum_permissions_user_section', 'user_id', 'section_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -194,6 +231,10 @@ class ForumPermission(Base):
 
 class UserFollow(Base):
     __tablename__ = 'user_follows'
+    __table_args__ = (
+        Index('ux_user_follows_pair', 'follower_id', 'followed_id', unique=True),
+        Index('ix_user_follows_followed', 'followed_id'),
+    )
     id = Column(Integer, primary_key=True)
     follower_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # 关注者
     followed_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # 被关注者
@@ -205,10 +246,14 @@ class UserFollow(Base):
 # 记录用户最后查看时间的表：聊天室与贴吧分区
 class ChatLastView(Base):
     __tablename__ = 'chat_last_views'
+    __table_args__ = (
+        Index('ux_chat_last_views_user_room', 'user_id', 'room_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     room_id = Column(Integer, ForeignKey('chat_rooms.id'), nullable=False)
     last_view = Column(DateTime, default=datetime.utcnow)
+    seen_seq = Column(Integer, default=0)  # 最后查看时聊天室的 message_seq
 
     user = relationship('User')
     room = relationship('ChatRoom')
@@ -216,10 +261,14 @@ class ChatLastView(Base):
 
 class ForumLastView(Base):
     __tablename__ = 'forum_last_views'
+    __table_args__ = (
+        Index('ux_forum_last_views_user_section', 'user_id', 'section_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     section_id = Column(Integer, ForeignKey('forum_sections.id'), nullable=False)
     last_view = Column(DateTime, default=datetime.utcnow)
+    seen_seq = Column(Integer, default=0)  # 最后查看时分区的 activity_seq
 
     user = relationship('User')
     section = relationship('ForumSection')
@@ -248,6 +297,49 @@ def normalize_permission_value(value):
     return None
 
 
+def load_permission_snapshot(user_id):
+    """一次查询加载用户在所有聊天室和贴吧分区上的权限
+    返回 {'chat': {room_id: perm}, 'forum': {section_id: perm}}，权限值已规范化
+    """
+    chat_q = db_session.query(
+        literal('chat').label('scope'), ChatPermission.room_id.label('target_id'), ChatPermission.perm
+    ).filter(ChatPermission.user_id == user_id)
+    forum_q = db_session.query(
+        literal('forum').label('scope'), ForumPermission.section_id.label('target_id'), ForumPermission.perm
+    ).filter(ForumPermission.user_id == user_id)
+
+    snapshot = {'chat': {}, 'forum': {}}
+    for scope, target_id, perm in db_session.execute(union_all(chat_q.statement, forum_q.statement)):
+        # 规范化权限值以避免数据库中存储格式差异导致的比较失败
+        snapshot[scope][target_id] = normalize_permission_value(perm)
+    return snapshot
+
+
+def get_permission_snapshot(user):
+    """获取用户权限快照，在同一个请求/Socket 事件内复用"""
+    if not has_app_context():
+        return load_permission_snapshot(user.id)
+    cache = g.setdefault('permission_snapshots', {})
+    snapshot = cache.get(user.id)
+    if snapshot is None:
+        snapshot = load_permission_snapshot(user.id)
+        cache[user.id] = snapshot
+    return snapshot
+
+
+def invalidate_permission_snapshot(user_id=None):
+    """权限变更后使快照失效；user_id 为 None 时清空全部"""
+    if not has_app_context():
+        return
+    cache = g.get('permission_snapshots')
+    if not cache:
+        return
+    if user_id is None:
+        cache.clear()
+    else:
+        cache.pop(user_id, None)
+
+
 def get_chat_permission_value(user, room_id):
     """获取用户在指定聊天室的权限"""
     # 明确只对 None 做空值判断，避免 0 或者其他可判断值被错误当作空
@@ -255,9 +347,7 @@ def get_chat_permission_value(user, room_id):
         return 'Null'
     if user.is_admin():
         return 'su'
-    perm = db_session.query(ChatPermission).filter_by(user_id=user.id, room_id=room_id).first()
-    # 规范化权限值以避免数据库中存储格式差异导致的比较失败
-    return normalize_permission_value(perm.perm) if perm else 'Null'
+    return get_permission_snapshot(user)['chat'].get(room_id, 'Null')
 
 
 def get_forum_permission_value(user, section_id):
@@ -267,9 +357,7 @@ def get_forum_permission_value(user, section_id):
         return 'Null'
     if user.is_admin():
         return 'su'
-    perm = db_session.query(ForumPermission).filter_by(user_id=user.id, section_id=section_id).first()
-    # 规范化权限值以避免数据库中存储格式差异导致的比较失败
-    return normalize_permission_value(perm.perm) if perm else 'Null'
+    return get_permission_snapshot(user)['forum'].get(section_id, 'Null')
 
 
 def user_can_view_chat(user, room_id):
@@ -288,69 +376,190 @@ def user_can_post_forum(user, section_id):
     return get_forum_permission_value(user, section_id) in FORUM_POST_PERMISSIONS
 
 
-# 检查并更新数据库结构
-def update_database_schema():
-    """检查并更新数据库结构，添加缺失的列"""
-    try:
-        conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
-        cursor = conn.cursor()
-        
-        # 检查用户表是否已有role列
-        cursor.execute("PRAGMA table_info(users);")
-        columns = [column[1] for column in cursor.fetchall()]
-        
-        if 'role' not in columns:
-            # 添加role列，默认为'user'
-            cursor.execute("ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT 'user';")
-            conn.commit()
-            logger.info("已添加role列到users表")
-        
-        conn.close()
-        logger.info("数据库结构更新完成")
-    except Exception as e:
-        logger.error(f"数据库结构更新失败: {str(e)}")
-
+# ----------
+# 数据库迁移
+# ----------
 
-def ensure_permission_tables():
-    """确保权限表存在并且为所有 admin 用户分配 su 权限"""
-    try:
-        conn = sqlite3.connect(app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', ''))
-        cursor = conn.cursor()
+# 已注册的迁移：(版本号, 描述, 函数)，按版本号顺序执行且每个版本只执行一次
+SCHEMA_MIGRATIONS = []
+
+
+def migration(version, description):
+    """注册一个数据库迁移，函数接收处于事务中的 SQLAlchemy 连接"""
+    def decorator(func):
+        SCHEMA_MIGRATIONS.append((version, description, func))
+        SCHEMA_MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return decorator
+
+
+def table_columns(conn, table):
+    """返回表中已有的列名集合"""
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+
+def dedupe_rows(conn, table, key_columns, merge_column=None):
+    """按 key_columns 去重，保留 id 最小的行；merge_column 指定时把其中的最大值合并到保留行"""
+    keys = ', '.join(key_columns)
+    if merge_column:
+        match = ' AND '.join(f"d.{col} = {table}.{col}" for col in key_columns)
+        conn.execute(text(f"""
+            UPDATE {table}
+            SET {merge_column} = (SELECT MAX(d.{merge_column}) FROM {table} d WHERE {match})
+            WHERE id IN (SELECT MIN(id) FROM {table} GROUP BY {keys} HAVING COUNT(*) > 1)
+        """))
+    result = conn.execute(text(f"""
+        DELETE FROM {table}
+        WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {keys})
+    """))
+    if result.rowcount:
+        logger.info(f"表 {table} 删除了 {result.rowcount} 条重复记录")
+
+
+@migration(1, '为 users 表添加 role 列')
+def migrate_add_user_role(conn):
+    if 'role' not in table_columns(conn, 'users'):
+        conn.execute(text("ALTER TABLE users ADD COLUMN role VARCHAR(20) DEFAULT 'user'"))
+
+
+@migration(2, '权限、关注、最后查看表去重并建立唯一索引；聊天消息复合索引')
+def migrate_composite_indexes(conn):
+    dedupe_rows(conn, 'chat_permissions', ('user_id', 'room_id'))
+    dedupe_rows(conn, 'forum_permissions', ('user_id', 'section_id'))
+    dedupe_rows(conn, 'user_follows', ('follower_id', 'followed_id'))
+    dedupe_rows(conn, 'chat_last_views', ('user_id', 'room_id'), merge_column='last_view')
+    dedupe_rows(conn, 'forum_last_views', ('user_id', 'section_id'), merge_column='last_view')
+
+    statements = [
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_chat_permissions_user_room ON chat_permissions (user_id, room_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_forum_permissions_user_section ON forum_permissions (user_id, section_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_user_follows_pair ON user_follows (follower_id, followed_id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_follows_followed ON user_follows (followed_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_chat_last_views_user_room ON chat_last_views (user_id, room_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_forum_last_views_user_section ON forum_last_views (user_id, section_id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_room_id_id ON chat_messages (room_id, id)",
+        "CREATE INDEX IF NOT EXISTS ix_chat_messages_room_timestamp ON chat_messages (room_id, timestamp)",
+    ]
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+@migration(3, '未读计数序号列，并按现有最后查看时间回填')
+def migrate_unread_sequences(conn):
+    for table, column in (
+        ('chat_rooms', 'message_seq'),
+        ('forum_sections', 'activity_seq'),
+        ('chat_last_views', 'seen_seq'),
+        ('forum_last_views', 'seen_seq'),
+    ):
+        if column not in table_columns(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER DEFAULT 0"))
+
+    # 序号取当前消息总数；已查看序号取最后查看时间之前的数量，使升级前后的未读数一致
+    conn.execute(text("""
+        UPDATE chat_rooms
+        SET message_seq = (SELECT COUNT(*) FROM chat_messages m WHERE m.room_id = chat_rooms.id)
+    """))
+    conn.execute(text("""
+        UPDATE chat_last_views
+        SET seen_seq = (
+            SELECT COUNT(*) FROM chat_messages m
+            WHERE m.room_id = chat_last_views.room_id AND m.timestamp <= chat_last_views.last_view
+        )
+    """))
+    conn.execute(text("""
+        UPDATE forum_sections
+        SET activity_seq = (SELECT COUNT(*) FROM forum_threads t WHERE t.section_id = forum_sections.id)
+            + (SELECT COUNT(*) FROM forum_replies r JOIN forum_threads t ON r.thread_id = t.id
+               WHERE t.section_id = forum_sections.id)
+    """))
+    conn.execute(text("""
+        UPDATE forum_last_views
+        SET seen_seq = (
+            SELECT COUNT(*) FROM forum_threads t
+            WHERE t.section_id = forum_last_views.section_id AND t.timestamp <= forum_last_views.last_view
+        ) + (
+            SELECT COUNT(*) FROM forum_replies r JOIN forum_threads t ON r.thread_id = t.id
+            WHERE t.section_id = forum_last_views.section_id AND r.timestamp <= forum_last_views.last_view
+        )
+    """))
+
+
+@migration(4, '主题帖冗余回复数与最后回复时间，以及分区排序索引')
+def migrate_thread_reply_stats(conn):
+    columns = table_columns(conn, 'forum_threads')
+    if 'reply_count' not in columns:
+        conn.execute(text("ALTER TABLE forum_threads ADD COLUMN reply_count INTEGER DEFAULT 0"))
+    if 'last_reply_at' not in columns:
+        conn.execute(text("ALTER TABLE forum_threads ADD COLUMN last_reply_at DATETIME"))
+
+    conn.execute(text("""
+        UPDATE forum_threads
+        SET reply_count = (SELECT COUNT(*) FROM forum_replies r WHERE r.thread_id = forum_threads.id),
+            last_reply_at = COALESCE(
+                (SELECT MAX(r.timestamp) FROM forum_replies r WHERE r.thread_id = forum_threads.id),
+                forum_threads.timestamp
+            )
+    """))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_forum_threads_section_timestamp ON forum_threads (section_id, timestamp)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_forum_threads_section_last_reply ON forum_threads (section_id, last_reply_at)"
+    ))
+
+
+@migration(5, '回复 (thread_id, id) 游标分页索引')
+def migrate_reply_keyset_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_forum_replies_thread_id_id ON forum_replies (thread_id, id)"))
+
+
+@migration(6, '聊天消息 client_id 幂等键及 (user_id, client_id) 唯一索引')
+def migrate_chat_client_id(conn):
+    if 'client_id' not in table_columns(conn, 'chat_messages'):
+        conn.execute(text("ALTER TABLE chat_messages ADD COLUMN client_id VARCHAR(64)"))
+    # 旧消息 client_id 均为 NULL，唯一索引不约束 NULL
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_chat_messages_user_client ON chat_messages (user_id, client_id)"
+    ))
+
+
+@migration(7, '聊天消息预渲染 HTML 列')
+def migrate_chat_content_html(conn):
+    if 'content_html' not in table_columns(conn, 'chat_messages'):
+        conn.execute(text("ALTER TABLE chat_messages ADD COLUMN content_html TEXT"))
+
+
+def run_migrations():
+    """按版本顺序执行尚未应用的迁移，每个迁移在独立事务中完成"""
+    with engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description VARCHAR(255),
+                applied_at DATETIME
+            )
+        """))
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
 
-        # 检查表是否存在；若不存在，创建表
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chat_permissions';")
-        if not cursor.fetchone():
-            cursor.execute('''
-                CREATE TABLE chat_permissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    room_id INTEGER NOT NULL,
-                    perm VARCHAR(10) DEFAULT 'Null'
-                )
-            ''')
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='forum_permissions';")
-        if not cursor.fetchone():
-            cursor.execute('''
-                CREATE TABLE forum_permissions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    section_id INTEGER NOT NULL,
-                    perm VARCHAR(10) DEFAULT 'Null'
+    for version, description, func in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as conn:
+                func(conn)
+                conn.execute(
+                    text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                    {'v': version, 'd': description, 't': datetime.utcnow()}
                 )
-            ''')
+            logger.info(f"已应用数据库迁移 {version}: {description}")
+        except Exception as e:
+            logger.error(f"数据库迁移 {version} 失败: {str(e)}")
+            raise
 
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"确保权限表失败: {str(e)}")
 
-
-# 确保权限表存在
-ensure_permission_tables()
-
-# 应用启动时更新数据库结构
-update_database_schema()
+# 应用启动时执行数据库迁移
+run_migrations()
 
 # 确保admin用户是管理员
 def ensure_admin_user():
@@ -383,30 +592,36 @@ ensure_admin_user()
 
 # 自动为所有管理员用户分配所有分区的 su 权限
 def grant_su_to_admins():
+    """以集合方式为所有管理员补齐 su 权限行：每个范围一条 INSERT ... SELECT 加一条 UPDATE"""
     try:
-        admins = db_session.query(User).filter_by(role='admin').all()
-        rooms = db_session.query(ChatRoom).all()
-        sections = db_session.query(ForumSection).all()
-
-        for admin in admins:
-            # 聊天室权限
-            for room in rooms:
-                existing = db_session.query(ChatPermission).filter_by(user_id=admin.id, room_id=room.id).first()
-                if not existing:
-                    db_session.add(ChatPermission(user_id=admin.id, room_id=room.id, perm='su'))
-                else:
-                    existing.perm = 'su'
-
-            # 贴吧分区权限
-            for section in sections:
-                existing = db_session.query(ForumPermission).filter_by(user_id=admin.id, section_id=section.id).first()
-                if not existing:
-                    db_session.add(ForumPermission(user_id=admin.id, section_id=section.id, perm='su'))
-                else:
-                    existing.perm = 'su'
+        admin_ids = select(User.id).where(User.role == 'admin')
+
+        for model, target_model, target_col in (
+            (ChatPermission, ChatRoom, ChatPermission.room_id),
+            (ForumPermission, ForumSection, ForumPermission.section_id),
+        ):
+            # 已有但不是 su 的权限行统一提升为 su
+            db_session.execute(
+                update(model)
+                .where(model.user_id.in_(admin_ids))
+                .where(or_(model.perm.is_(None), model.perm != 'su'))
+                .values(perm='su')
+            )
+            # 缺失的 (管理员, 分区) 组合一次性插入
+            missing = select(User.id, target_model.id, literal('su')).select_from(
+                User
+            ).join(target_model, true()).where(
+                User.role == 'admin',
+                ~exists().where(model.user_id == User.id, target_col == target_model.id)
+            )
+            db_session.execute(
+                insert(model).from_select([model.user_id, target_col, model.perm], missing)
+            )
 
         db_session.commit()
+        invalidate_permission_snapshot()
     except Exception as e:
+        db_session.rollback()
         logger.error(f"为管理员分配权限失败: {str(e)}")
 
 
@@ -482,26 +697,160 @@ def sanitize_content(content):
     
     return content
 
-def get_online_users(room_id):
-    """获取指定房间的在线用户"""
-    # 获取最近5分钟有活动的用户
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 实际上Flask-SocketIO没有内置的房间在线用户列表，我们需要自己维护
-    # 这里简化处理，返回最近活动的用户
-    recent_users = db_session.query(User).filter(User.last_seen >= cutoff_time).all()
-    
-    online_users = []
-    for user in recent_users:
-        online_users.append({
-            'id': user.id,
-            'username': user.username,
-            'nickname': user.nickname or user.username,
-            'color': user.color,
-            'badge': user.badge
-        })
-    
-    return online_users
+
+# 服务端预渲染（SERVER_RENDER，依赖可选的 markdown 包）：Markdown 只在服务端渲染一次，
+# 按内容哈希缓存在 LRU 中，客户端直接显示 html 字段，不再运行 marked 与 LaTeX 正则。
+# 渲染的是用户原文（关闭原始 HTML），输出再按标签/属性白名单过滤；content 字段仍是 sanitize_content 转义后的文本。
+# LaTeX 公式在 Markdown 解析前取出，输出为带 math-inline / math-block 类的元素，由客户端 KaTeX 逐个排版。
+_render_cache = OrderedDict()  # {sha1(原文): html}
+_render_lock = threading.Lock()
+_markdown_state = {'renderer': None, 'loaded': False}
+_markdown_lock = threading.Lock()  # Markdown 实例非线程安全
+# 代码块与行内代码排在公式之前匹配，其中的 $ 等符号原样保留，不当作公式
+_MATH_PATTERN = re.compile(
+    r'(?P<code>^(?P<fence>`{3,}|~{3,})[^\n]*\n.*?^(?P=fence)[ \t]*$|(?P<ticks>`+)(?!`).+?(?<!`)(?P=ticks)(?!`))'
+    r'|\$\$(?P<display>.+?)\$\$|\\\[(?P<bracket>.+?)\\\]|\\\((?P<paren>.+?)\\\)|\$(?P<inline>[^$\n]+?)\$',
+    re.S | re.M
+)
+_SAFE_URL_PATTERN = re.compile(r'^(https?:|mailto:|/|#|[^:/?#]*(?:[/?#]|$))', re.I)
+# 渲染结果允许保留的标签及其属性
+_RENDER_ALLOWED_TAGS = {
+    'p': (), 'br': (), 'hr': (), 'strong': (), 'em': (), 'b': (), 'i': (), 'del': (),
+    'code': ('class',), 'pre': (), 'blockquote': (), 'ul': (), 'ol': ('start',), 'li': (),
+    'h1': (), 'h2': (), 'h3': (), 'h4': (), 'h5': (), 'h6': (),
+    'table': (), 'thead': (), 'tbody': (), 'tr': (), 'th': ('align',), 'td': ('align',),
+    'a': ('href', 'title'), 'img': ('src', 'alt', 'title'),
+    'span': ('class',), 'div': ('class',),
+}
+_RENDER_VOID_TAGS = {'br', 'hr', 'img'}
+_RENDER_CLASS_PATTERN = re.compile(r'^(math-inline|math-block|language-[\w+-]+)$')
+
+
+class RenderedHtmlSanitizer(HTMLParser):
+    """按白名单重建渲染结果：不在白名单的标签去掉（保留文字），属性只留允许的，链接只留安全协议"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        allowed = _RENDER_ALLOWED_TAGS.get(tag)
+        if allowed is None:
+            return
+        kept = []
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in ('href', 'src') and not _SAFE_URL_PATTERN.match(re.sub(r'[\x00-\x20]', '', value)):
+                continue
+            if name == 'class' and not _RENDER_CLASS_PATTERN.match(value):
+                continue
+            kept.append(f' {name}="{html.escape(value, quote=True)}"')
+        if tag == 'a':
+            kept.append(' target="_blank" rel="noopener noreferrer"')
+        self.parts.append(f"<{tag}{''.join(kept)}>")
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in _RENDER_ALLOWED_TAGS and tag not in _RENDER_VOID_TAGS:
+            self.parts.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        self.parts.append(html.escape(data, quote=False))
+
+
+def sanitize_rendered_html(rendered):
+    """按白名单过滤渲染结果"""
+    sanitizer = RenderedHtmlSanitizer()
+    sanitizer.feed(rendered)
+    sanitizer.close()
+    return ''.join(sanitizer.parts)
+
+
+def _get_markdown_renderer():
+    """延迟创建 Markdown 渲染器（关闭原始 HTML，原文中的标签按文本输出）；未安装 markdown 包时返回 None"""
+    if not _markdown_state['loaded']:
+        _markdown_state['loaded'] = True
+        try:
+            import markdown
+            renderer = markdown.Markdown(extensions=['fenced_code', 'tables', 'sane_lists'])
+            renderer.preprocessors.deregister('html_block')
+            renderer.inlinePatterns.deregister('html')
+            _markdown_state['renderer'] = renderer
+        except ImportError:
+            logger.warning("未安装 markdown，服务端预渲染已停用")
+    return _markdown_state['renderer']
+
+
+def _render_markdown(content, renderer):
+    """渲染一段 Markdown 原文：公式先替换为本次调用独有的占位符，渲染后放回，最后按白名单过滤"""
+    formulas = []
+    token = f"MATH{uuid.uuid4().hex}"
+
+    def stash(match):
+        if match.group('code') is not None:
+            return match.group(0)
+        block = match.group('display') is not None or match.group('bracket') is not None
+        tex = next(match.group(name) for name in ('display', 'bracket', 'paren', 'inline') if match.group(name) is not None)
+        formulas.append((block, tex))
+        return f"{token}X{len(formulas) - 1}X"
+
+    source = _MATH_PATTERN.sub(stash, content)
+    with _markdown_lock:
+        renderer.reset()
+        rendered = renderer.convert(source)
+
+    def restore(match):
+        index = int(match.group(1))
+        if index >= len(formulas):
+            return match.group(0)
+        block, tex = formulas[index]
+        if block:
+            return f'<div class="math-block">{html.escape(tex)}</div>'
+        return f'<span class="math-inline">{html.escape(tex)}</span>'
+
+    return sanitize_rendered_html(re.sub(token + r'X(\d+)X', restore, rendered))
+
+
+def render_content(content):
+    """把 Markdown 原文渲染为安全的 HTML，按内容哈希缓存；未开启或缺少依赖时返回 None"""
+    if not content or not app.config.get('SERVER_RENDER'):
+        return None
+    renderer = _get_markdown_renderer()
+    if renderer is None:
+        return None
+
+    key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    with _render_lock:
+        cached = _render_cache.get(key)
+        if cached is not None:
+            _render_cache.move_to_end(key)
+            return cached
+
+    try:
+        rendered = _render_markdown(content, renderer)
+    except Exception:
+        logger.exception('服务端渲染失败，交由客户端渲染')
+        return None
+
+    with _render_lock:
+        _render_cache[key] = rendered
+        while len(_render_cache) > app.config.get('RENDER_CACHE_SIZE', 2000):
+            _render_cache.popitem(last=False)
+    return rendered
+
+
+def render_stored_content(content):
+    """渲染数据库中保存的内容：保存的是 sanitize_content 转义后的文本，先还原为原文再渲染"""
+    return render_content(html.unescape(content)) if content else None
+
+
+def prepare_content(content):
+    """发送/发帖/回复共用的内容处理，返回 (sanitize_content 转义后的文本, 由原文渲染的 html 或 None)"""
+    return sanitize_content(content), render_content(content)
+
 
 def get_recent_logs(limit=10):
     """获取最近的系统日志"""
@@ -580,8 +929,7 @@ def login():
             return redirect(url_for('login'))
         
         login_user(user)
-        user.last_seen = datetime.utcnow()
-        db_session.commit()
+        presence_touch(user.id)
         log_admin_action(f"用户登录: {user.username}")
         return redirect(url_for('chat_index'))
     
@@ -621,6 +969,7 @@ def profile():
         current_user.color = form.color.data or '#000000'
         current_user.badge = form.badge.data
         db_session.commit()
+        invalidate_recent_messages()
         log_admin_action(f"用户更新个人资料: {current_user.username}")
         flash('个人资料已更新', 'success')
         return redirect(url_for('profile'))
@@ -662,79 +1011,805 @@ def chat_room(room_id):
     try:
         last = db_session.query(ChatLastView).filter_by(user_id=current_user.id, room_id=room_id).first()
         now = datetime.utcnow()
+        seen_seq = select(ChatRoom.message_seq).where(ChatRoom.id == room_id).scalar_subquery() \
+            + pending_chat_counts().get(room_id, 0)
         if last:
             last.last_view = now
+            last.seen_seq = seen_seq
         else:
-            db_session.add(ChatLastView(user_id=current_user.id, room_id=room_id, last_view=now))
+            db_session.add(ChatLastView(user_id=current_user.id, room_id=room_id, last_view=now, seen_seq=seen_seq))
         db_session.commit()
     except Exception:
         db_session.rollback()
 
     return render_template('chat/room.html', room=room, room_permission=permission)
 
-@app.route('/api/chat/<int:room_id>/history')
-@login_required
-def chat_history(room_id):
-    """获取聊天历史消息 - 只返回原始Markdown内容"""
-    if not user_can_view_chat(current_user, room_id):
-        return jsonify(success=False, message="权限不足"), 403
-
-    limit = min(request.args.get('limit', 50, type=int), 100)
-    offset = request.args.get('offset', 0, type=int)
-    
-    # 按时间戳升序排列（最旧的在前），确保消息按时间顺序排列
-    messages = db_session.query(ChatMessage).filter_by(room_id=room_id)\
-        .order_by(ChatMessage.timestamp.asc()).limit(limit).offset(offset).all()
-    
-    # 转换为字典列表（只返回原始内容）
-    messages_data = [{
+def serialize_chat_message(msg):
+    """把聊天消息转换为返回给客户端的字典（原始Markdown内容，开启服务端渲染时附带 html）"""
+    return {
         'id': msg.id,
         'content': msg.content,  # 原始Markdown内容
+        'html': msg.content_html if msg.content_html is not None else render_stored_content(msg.content),
         'timestamp': msg.timestamp.isoformat(),
         'user_id': msg.user_id,
         'username': msg.user.username,
         'nickname': msg.user.nickname or msg.user.username,
         'color': msg.user.color,
-        'badge': msg.user.badge
-    } for msg in messages]  # 保持顺序，按时间升序
-    
-    return jsonify(messages=messages_data)
+        'badge': msg.user.badge,
+        'client_id': msg.client_id
+    }
 
-@app.route('/api/chat/send', methods=['POST'])
+
+# 最近消息环形缓冲：{room_id: {'messages': deque(payload), 'complete': bool}}
+# complete 表示缓冲中已包含该房间的全部消息；按最近访问顺序排列，超过全局上限时淘汰最久未用的房间
+_recent_messages = OrderedDict()
+_recent_messages_lock = threading.Lock()
+_recent_messages_state = {'total': 0}  # 所有房间缓冲的消息总数，随追加、截断、淘汰、失效增量维护
+
+
+def _evict_recent_messages(keep_room_id):
+    """全局缓存消息数超过 CHAT_CACHE_MAX_MESSAGES 时淘汰最久未访问的房间（调用方持有锁）"""
+    limit = app.config.get('CHAT_CACHE_MAX_MESSAGES', 20000)
+    while _recent_messages_state['total'] > limit and len(_recent_messages) > 1:
+        room_id, entry = next(iter(_recent_messages.items()))
+        if room_id == keep_room_id:
+            _recent_messages.move_to_end(room_id)
+            continue
+        _recent_messages.pop(room_id)
+        _recent_messages_state['total'] -= len(entry['messages'])
+
+
+def warm_recent_messages(room_id):
+    """从数据库加载房间最新的 CHAT_CACHE_PER_ROOM 条消息到缓冲
+
+    写后队列中尚未提交的消息一并并入：先取队列快照再查数据库，
+    快照之后才提交的行会出现在查询结果中，按 id 去重排序后不会漏掉。
+    """
+    size = app.config.get('CHAT_CACHE_PER_ROOM', 200)
+    pending = pending_chat_payloads(room_id)
+    rows = db_session.query(ChatMessage).options(joinedload(ChatMessage.user))\
+        .filter(ChatMessage.room_id == room_id)\
+        .order_by(ChatMessage.id.desc()).limit(size + 1).all()
+    merged = {payload['id']: payload for payload in pending}
+    for msg in rows[:size]:
+        merged.setdefault(msg.id, serialize_chat_message(msg))
+    entry = {
+        'messages': deque((merged[message_id] for message_id in sorted(merged)), maxlen=size),
+        'complete': len(rows) <= size and len(merged) <= size
+    }
+    with _recent_messages_lock:
+        previous = _recent_messages.pop(room_id, None)
+        if previous is not None:
+            _recent_messages_state['total'] -= len(previous['messages'])
+        _recent_messages[room_id] = entry
+        _recent_messages_state['total'] += len(entry['messages'])
+        _evict_recent_messages(room_id)
+    return entry
+
+
+def get_recent_messages(room_id):
+    """返回房间的缓冲（必要时从数据库预热），并标记为最近使用"""
+    with _recent_messages_lock:
+        entry = _recent_messages.get(room_id)
+        if entry is not None:
+            _recent_messages.move_to_end(room_id)
+            return entry
+    return warm_recent_messages(room_id)
+
+
+def cache_chat_message(room_id, payload):
+    """新消息提交后追加到已预热的缓冲；未预热的房间等下次读取时再加载
+
+    开启写后队列时未预热的房间立即预热：消息尚未落盘，等到下次读取时数据库里可能还没有它。
+    """
+    with _recent_messages_lock:
+        entry = _recent_messages.get(room_id)
+    if entry is None:
+        if app.config.get('CHAT_WRITE_BEHIND'):
+            warm_recent_messages(room_id)  # 预热结果已包含队列中的这条消息
+        return
+    with _recent_messages_lock:
+        messages = entry['messages']
+        # 并发预热可能已从写后队列并入这条消息
+        if messages and messages[-1]['id'] >= payload['id'] and any(m['id'] == payload['id'] for m in messages):
+            return
+        if len(messages) == messages.maxlen:
+            entry['complete'] = False
+        else:
+            _recent_messages_state['total'] += 1  # 缓冲已满时追加会挤掉最旧的一条，总数不变
+        messages.append(payload)
+        _recent_messages.move_to_end(room_id)
+        _evict_recent_messages(room_id)
+
+
+def discard_cached_message(room_id, message_id):
+    """删除单条消息后从缓冲中移除"""
+    with _recent_messages_lock:
+        entry = _recent_messages.get(room_id)
+        if entry is not None:
+            remaining = deque(
+                (m for m in entry['messages'] if m['id'] != message_id), maxlen=entry['messages'].maxlen
+            )
+            _recent_messages_state['total'] -= len(entry['messages']) - len(remaining)
+            entry['messages'] = remaining
+
+
+def invalidate_recent_messages(room_id=None):
+    """批量删除消息或用户资料变化后丢弃缓冲；room_id 为 None 时清空全部"""
+    with _recent_messages_lock:
+        if room_id is None:
+            _recent_messages.clear()
+            _recent_messages_state['total'] = 0
+        else:
+            entry = _recent_messages.pop(room_id, None)
+            if entry is not None:
+                _recent_messages_state['total'] -= len(entry['messages'])
+
+
+def cached_chat_page(room_id, after_id=None, limit=50):
+    """尝试只用内存缓冲回答最新一页或 after_id 追赶请求
+
+    返回 (payloads, prev, next, has_more)；缓冲不足以给出准确结果时返回 None，由调用方回退到数据库。
+    """
+    entry = get_recent_messages(room_id)
+    messages = list(entry['messages'])
+    complete = entry['complete']
+
+    if after_id is None:
+        # 删除造成缓冲不足一页且不完整时回退
+        if len(messages) < limit and not complete:
+            return None
+        page = messages[-limit:]
+        has_older = len(messages) > limit or not complete
+        prev_cursor = page[0]['id'] if page and has_older else None
+        next_cursor = page[-1]['id'] if page else None
+        return page, prev_cursor, next_cursor, False
+
+    # 只有缓冲覆盖 after_id 之后的全部消息时才能回答
+    if not complete and (not messages or messages[0]['id'] > after_id):
+        return None
+    newer = [m for m in messages if m['id'] > after_id]
+    page = newer[:limit]
+    next_cursor = page[-1]['id'] if page else after_id
+    prev_cursor = page[0]['id'] if page else None
+    return page, prev_cursor, next_cursor, len(newer) > limit
+
+
+def query_chat_page(room_id, before_id=None, after_id=None, limit=50):
+    """按 (room_id, id) 游标查询一页聊天消息，返回 (messages, prev, next, has_more)
+
+    messages 按 id 升序；prev 为继续向前翻页的 before_id（没有更早消息时为 None），
+    next 为继续追赶的 after_id。
+    """
+    # 作者随消息一起 JOIN 加载，序列化时不再逐条查询用户
+    query = db_session.query(ChatMessage).options(joinedload(ChatMessage.user))\
+        .filter(ChatMessage.room_id == room_id)
+    if after_id is not None:
+        # 追赶：从游标处向后取 limit+1 条以判断是否还有更多
+        rows = query.filter(ChatMessage.id > after_id)\
+            .order_by(ChatMessage.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        messages = rows[:limit]
+        has_older = True
+    else:
+        if before_id is not None:
+            query = query.filter(ChatMessage.id < before_id)
+        rows = query.order_by(ChatMessage.id.desc()).limit(limit + 1).all()
+        has_older = len(rows) > limit
+        messages = list(reversed(rows[:limit]))
+        has_more = before_id is not None
+
+    prev_cursor = messages[0].id if messages and has_older else None
+    next_cursor = messages[-1].id if messages else after_id
+    return messages, prev_cursor, next_cursor, has_more
+
+
+@app.route('/api/chat/<int:room_id>/history')
 @login_required
-def send_chat_message():
-    data = request.get_json(silent=True)
-    if data:
-        room_id = data.get('room_id')
-        message = data.get('message', '')
+def chat_history(room_id):
+    """获取聊天历史消息（基于 (room_id, id) 索引的游标分页）
+
+    - latest=N（默认 50）：最新的 N 条消息
+    - before_id=X：id 小于 X 的较早消息，用于向上翻页
+    - after_id=X：id 大于 X 的较新消息，用于断线追赶
+    """
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('latest', type=int) or request.args.get('limit', 50, type=int)
+    limit = max(1, min(limit, 100))
+
+    # 最新一页和追赶请求优先由内存缓冲回答
+    page = cached_chat_page(room_id, after_id, limit) if before_id is None else None
+    if page is not None:
+        messages_data, prev_cursor, next_cursor, has_more = page
     else:
-        room_id = request.form.get('room_id')
-        message = request.form.get('message', '')
+        messages, prev_cursor, next_cursor, has_more = query_chat_page(room_id, before_id, after_id, limit)
+        messages_data = [serialize_chat_message(msg) for msg in messages]
+    return jsonify(messages=messages_data, prev=prev_cursor, next=next_cursor, has_more=has_more)
+
+
+@app.route('/api/chat/<int:room_id>/updates')
+@login_required
+def chat_updates(room_id):
+    """轮询降级使用的增量接口：只返回 after_id 之后的新消息
+
+    没有新消息时返回 204；ETag 由房间最新消息 id 构成，客户端携带 If-None-Match 且未变化时返回 304。
+    只有让客户端追到最新的响应才带 ETag（has_more 为真的分页响应不带）。
+    """
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    after_id = request.args.get('after_id', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 100))
+
+    # 最新消息 id 来自内存缓冲，空闲轮询不访问数据库
+    recent = get_recent_messages(room_id)['messages']
+    latest_id = recent[-1]['id'] if recent else 0
+    if not recent:
+        # 缓冲为空（房间无消息或刚被删空）时走 (room_id, id) 索引确认
+        latest_id = db_session.query(func.max(ChatMessage.id)).filter(ChatMessage.room_id == room_id).scalar() or 0
+    etag = f"room-{room_id}-{latest_id}"
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    if latest_id <= after_id:
+        response = make_response('', 204)
+        response.set_etag(etag)
+        return response
+
+    page = cached_chat_page(room_id, after_id=after_id, limit=limit)
+    if page is not None:
+        messages_data, _, next_cursor, has_more = page
+    else:
+        messages, _, next_cursor, has_more = query_chat_page(room_id, after_id=after_id, limit=limit)
+        messages_data = [serialize_chat_message(msg) for msg in messages]
+    response = jsonify(messages=messages_data, next=next_cursor, has_more=has_more)
+    if not has_more:
+        response.set_etag(etag)
+    return response
+
+
+# 长轮询 / SSE 订阅者：{room_id: set(queue)}，handle_message 提交后立即扇出
+_chat_subscribers = {}
+_chat_subscribers_lock = threading.Lock()
+# 订阅者积压超过该数量视为失效，结束其连接让客户端按游标重连
+CHAT_SUBSCRIBER_MAX_BACKLOG = 500
+
+
+def subscribe_chat_room(room_id):
+    """为长轮询/SSE 连接创建一个与当前异步模型匹配的队列并登记到房间"""
+    queue = socketio.server.eio.create_queue()
+    with _chat_subscribers_lock:
+        _chat_subscribers.setdefault(room_id, set()).add(queue)
+    return queue
+
+
+def unsubscribe_chat_room(room_id, queue):
+    with _chat_subscribers_lock:
+        subscribers = _chat_subscribers.get(room_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                _chat_subscribers.pop(room_id, None)
+
+
+def publish_chat_message(room_id, payload):
+    """把已提交的消息推送给该房间所有长轮询/SSE 订阅者"""
+    with _chat_subscribers_lock:
+        subscribers = list(_chat_subscribers.get(room_id, ()))
+    for queue in subscribers:
+        if queue.qsize() >= CHAT_SUBSCRIBER_MAX_BACKLOG:
+            # 消费过慢：移除并放入 None 通知连接结束
+            unsubscribe_chat_room(room_id, queue)
+            queue.put(None)
+            continue
+        queue.put(payload)
+
+
+def wait_chat_messages(queue, timeout):
+    """等待订阅队列中的消息，超时返回空列表；收到 None 表示订阅已失效"""
+    empty = socketio.server.eio.get_queue_empty_exception()
+    try:
+        first = queue.get(timeout=timeout)
+    except empty:
+        return []
+    messages = [first]
+    while True:
+        try:
+            messages.append(queue.get_nowait())
+        except empty:
+            return messages
+
+
+@app.route('/api/chat/<int:room_id>/poll')
+@login_required
+def chat_long_poll(room_id):
+    """长轮询：有 after_id 之后的消息时立即返回，否则挂起直到新消息到达或超时"""
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    after_id = request.args.get('after_id', 0, type=int)
+    timeout = min(request.args.get('timeout', app.config.get('LONG_POLL_TIMEOUT', 25), type=int),
+                  app.config.get('LONG_POLL_TIMEOUT', 25))
+
+    # 先订阅再查库，避免两步之间到达的消息丢失
+    queue = subscribe_chat_room(room_id)
+    try:
+        page = cached_chat_page(room_id, after_id=after_id, limit=100)
+        if page is not None:
+            messages_data, _, next_cursor, has_more = page
+        else:
+            messages, _, next_cursor, has_more = query_chat_page(room_id, after_id=after_id, limit=100)
+            messages_data = [serialize_chat_message(msg) for msg in messages]
+        db_session.remove()  # 挂起期间不占用数据库会话
+        if not messages_data:
+            messages_data = [m for m in wait_chat_messages(queue, timeout) if m and m['id'] > after_id]
+            next_cursor = messages_data[-1]['id'] if messages_data else after_id
+    finally:
+        unsubscribe_chat_room(room_id, queue)
+
+    return jsonify(messages=messages_data, next=next_cursor, has_more=has_more)
+
+
+@app.route('/api/chat/<int:room_id>/stream')
+@login_required
+def chat_stream(room_id):
+    """Server-Sent Events：推送 after_id（或 Last-Event-ID）之后的消息，并持续推送新消息"""
+    if not user_can_view_chat(current_user, room_id):
+        return jsonify(success=False, message="权限不足"), 403
+
+    after_id = request.headers.get('Last-Event-ID', type=int)
+    if after_id is None:
+        after_id = request.args.get('after_id', type=int)
+    keepalive = app.config.get('SSE_KEEPALIVE_INTERVAL', 15)
+
+    # 先订阅再补发，补发期间到达的新消息留在队列中，由 last_id 去重
+    queue = subscribe_chat_room(room_id)
+    db_session.remove()
+
+    def format_event(payload):
+        return f"id: {payload['id']}\nevent: message\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    def generate():
+        last_id = after_id or 0
+        try:
+            # 按 next 游标逐页补发，直到没有更多消息再进入实时推送
+            has_more = after_id is not None
+            while has_more:
+                messages, _, _, has_more = query_chat_page(room_id, after_id=last_id, limit=100)
+                backlog = [serialize_chat_message(msg) for msg in messages]
+                db_session.remove()
+                for payload in backlog:
+                    last_id = payload['id']
+                    yield format_event(payload)
+            # 写后队列中尚未落盘的消息在订阅前已推送过，补发给本连接
+            if after_id is not None:
+                backlog = [payload for payload in pending_chat_payloads(room_id) if payload['id'] > last_id]
+                db_session.remove()
+                for payload in backlog:
+                    last_id = payload['id']
+                    yield format_event(payload)
+            while True:
+                messages = wait_chat_messages(queue, keepalive)
+                if not messages:
+                    yield ": keepalive\n\n"
+                    continue
+                for payload in messages:
+                    if payload is None:
+                        return
+                    if payload['id'] <= last_id:
+                        continue
+                    last_id = payload['id']
+                    yield format_event(payload)
+        finally:
+            unsubscribe_chat_room(room_id, queue)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# 已启动的周期任务（按函数登记），每个函数只启动一个后台循环
+_periodic_tasks = set()
+_periodic_tasks_lock = threading.Lock()
+
+
+def start_periodic_task(config_key, default, fn):
+    """按需启动后台循环：每隔 app.config[config_key]（默认 default）秒调用一次 fn，重复调用无效果"""
+    with _periodic_tasks_lock:
+        if fn in _periodic_tasks:
+            return
+        _periodic_tasks.add(fn)
+
+    def loop():
+        while True:
+            socketio.sleep(app.config.get(config_key, default))
+            try:
+                fn()
+            except Exception:
+                logger.exception(f'后台任务 {fn.__name__} 执行失败')
+
+    socketio.start_background_task(loop)
+
+
+# 聊天消息写后（write-behind）队列，CHAT_WRITE_BEHIND 开启时使用：
+# - 消息 id 由进程内分配器按发送顺序分配（假定单进程部署），分配后立即广播；
+# - 后台任务每 CHAT_WRITE_BEHIND_INTERVAL 秒或积压 CHAT_WRITE_BEHIND_BATCH 条时，按 id 顺序在一个事务中批量插入；
+# - 持久性：广播早于落盘，进程崩溃会丢失最近一个间隔内尚未写入的消息；正常退出、管理员重启/关停前会写完队列；
+# - 写入前的短暂窗口内，数据库查询（历史回退、删除）看不到这些消息，最新消息由内存环形缓冲提供；
+# - 未读增量在发送时推送，而 message_seq 在落盘时才递增，未读统计与记录 seen_seq 时都会加上尚未提交的条数。
+_chat_write_queue = []
+_chat_write_inflight = []  # 已从队列取出、正在提交的行，提交结束后清空
+_chat_write_lock = threading.Lock()
+_chat_write_state = {'next_id': None}
+
+
+def _allocate_chat_message_id():
+    """分配下一个消息 id（调用方持有锁）；首次使用时从数据库当前最大 id 开始"""
+    if _chat_write_state['next_id'] is None:
+        with engine.connect() as conn:
+            _chat_write_state['next_id'] = (conn.execute(select(func.max(ChatMessage.id))).scalar() or 0) + 1
+    message_id = _chat_write_state['next_id']
+    _chat_write_state['next_id'] += 1
+    return message_id
+
+
+def _find_queued_chat_message(user_id, client_id):
+    """在写后队列与正在提交的行中查找同一用户、同一 client_id 的消息（调用方持有锁）
+
+    行在提交完成后才离开 _chat_write_inflight，因此先查这里、再查数据库不会漏掉任何已分配 id 的消息。
+    """
+    for rows in (_chat_write_queue, _chat_write_inflight):
+        for row in rows:
+            if row['client_id'] == client_id and row['user_id'] == user_id:
+                return row
+    return None
+
+
+def enqueue_chat_message(room_id, user_id, content, client_id=None, content_html=None):
+    """分配 id 并放入写后队列，返回 (row, created)；队列中已有相同 client_id 的消息时直接返回该行"""
+    start_flush = False
+    with _chat_write_lock:
+        if client_id:
+            row = _find_queued_chat_message(user_id, client_id)
+            if row is not None:
+                return row, False
+        row = {
+            'id': _allocate_chat_message_id(), 'content': content, 'timestamp': datetime.utcnow(),
+            'user_id': user_id, 'room_id': room_id, 'client_id': client_id, 'content_html': content_html
+        }
+        _chat_write_queue.append(row)
+        start_periodic_task('CHAT_WRITE_BEHIND_INTERVAL', 0.05, flush_chat_write_queue)
+        if len(_chat_write_queue) >= app.config.get('CHAT_WRITE_BEHIND_BATCH', 100):
+            start_flush = True
+    if start_flush:
+        socketio.start_background_task(flush_chat_write_queue)
+    return row, True
+
+
+def _insert_chat_rows(conn, rows):
+    """插入一批消息并按房间累加 message_seq"""
+    conn.execute(insert(ChatMessage.__table__), rows)
+    room_counts = {}
+    for row in rows:
+        room_counts[row['room_id']] = room_counts.get(row['room_id'], 0) + 1
+    for room_id, count in room_counts.items():
+        conn.execute(
+            update(ChatRoom).where(ChatRoom.id == room_id)
+            .values(message_seq=func.coalesce(ChatRoom.message_seq, 0) + count)
+        )
+
+
+def flush_chat_write_queue():
+    """把队列中的消息按 id 顺序在一个事务中写入；批量失败时逐条重试，仍失败的记录错误后丢弃"""
+    with _chat_write_lock:
+        if _chat_write_inflight or not _chat_write_queue:
+            return
+        rows = list(_chat_write_queue)
+        _chat_write_inflight.extend(rows)
+        del _chat_write_queue[:]
+    try:
+        try:
+            with engine.begin() as conn:
+                _insert_chat_rows(conn, rows)
+        except Exception:
+            logger.exception(f"批量写入 {len(rows)} 条聊天消息失败，改为逐条写入")
+            for row in rows:
+                try:
+                    with engine.begin() as conn:
+                        _insert_chat_rows(conn, [row])
+                except Exception:
+                    logger.error(f"聊天消息写入失败已丢弃: id={row['id']} room={row['room_id']} user={row['user_id']}")
+    finally:
+        with _chat_write_lock:
+            del _chat_write_inflight[:]
+
+
+def drain_chat_write_queue(timeout=10):
+    """退出前调用：等待进行中的批量写入结束，再反复写入直到队列为空"""
+    deadline = time.monotonic() + timeout
+    while True:
+        with _chat_write_lock:
+            busy = bool(_chat_write_inflight)
+            if not busy and not _chat_write_queue:
+                return
+        if busy:
+            if time.monotonic() > deadline:
+                logger.error(f"等待聊天消息写入超时，{len(_chat_write_queue)} 条消息未写入")
+                return
+            socketio.sleep(0.01)
+            continue
+        flush_chat_write_queue()
+
+
+def pending_chat_payloads(room_id):
+    """写后队列（含正在提交的行）中该房间尚未落盘的消息 payload，按 id 升序"""
+    with _chat_write_lock:
+        rows = [row for row in _chat_write_queue + _chat_write_inflight if row['room_id'] == room_id]
+    if not rows:
+        return []
+    users = {
+        user.id: user for user in
+        db_session.query(User).filter(User.id.in_({row['user_id'] for row in rows})).all()
+    }
+    return [
+        _queued_chat_payload(row, users[row['user_id']])
+        for row in sorted(rows, key=lambda row: row['id']) if row['user_id'] in users
+    ]
 
+
+def pending_chat_counts():
+    """写后队列中尚未提交的消息数 {room_id: count}，用于补齐还未递增的 message_seq"""
+    counts = {}
+    with _chat_write_lock:
+        for row in _chat_write_queue + _chat_write_inflight:
+            counts[row['room_id']] = counts.get(row['room_id'], 0) + 1
+    return counts
+
+
+def normalize_client_id(client_id):
+    """客户端幂等键：非空字符串且不超过 64 字符，否则视为未提供"""
+    if isinstance(client_id, str) and 0 < len(client_id) <= 64:
+        return client_id
+    return None
+
+
+def find_chat_message_by_client_id(user_id, client_id):
+    """按 (user_id, client_id) 查找已保存的消息（走唯一索引），未找到返回 None"""
+    return (
+        db_session.query(ChatMessage)
+        .options(joinedload(ChatMessage.user))
+        .filter_by(user_id=user_id, client_id=client_id)
+        .first()
+    )
+
+
+def _queued_chat_payload(row, user):
+    """把写后队列中的行转换为广播用的 payload"""
+    return {
+        'id': row['id'],
+        'content': row['content'],  # 原始Markdown内容
+        'html': row['content_html'] if row['content_html'] is not None else render_stored_content(row['content']),
+        'timestamp': row['timestamp'].isoformat(),
+        'user_id': user.id,
+        'username': user.username,
+        'nickname': user.nickname or user.username,
+        'color': user.color,
+        'badge': user.badge,
+        'client_id': row['client_id']
+    }
+
+
+def find_existing_chat_message(user, client_id):
+    """返回该用户已发送的同一 client_id 消息的 payload，没有则返回 None
+
+    先查写后队列（含正在提交的行）再查数据库：行提交完成后才从内存移除，两处之间没有空档。
+    """
+    with _chat_write_lock:
+        row = _find_queued_chat_message(user.id, client_id)
+    if row is not None:
+        return _queued_chat_payload(row, user)
+    existing = find_chat_message_by_client_id(user.id, client_id)
+    if existing is not None:
+        return serialize_chat_message(existing)
+    return None
+
+
+def persist_chat_message(room_id, user, content, client_id=None, rendered=None):
+    """保存一条聊天消息，返回 (payload, created)；开启写后队列时不等待落盘
+
+    rendered 为预渲染的 HTML，STORE_RENDERED_HTML 开启时一并保存。
+
+    调用方应先用 find_existing_chat_message 处理重试；这里只兜住并发到达的同一 client_id：
+    已有该 client_id 的消息时返回已有消息，created 为 False。
+    """
+    content_html = rendered if app.config.get('STORE_RENDERED_HTML') else None
+    if app.config.get('CHAT_WRITE_BEHIND'):
+        # 入队时在锁内再查一次，并发到达的同一 client_id 只会分配一个 id
+        row, created = enqueue_chat_message(room_id, user.id, content, client_id, content_html)
+        return _queued_chat_payload(row, user), created
+
+    message = ChatMessage(
+        content=content,  # 存储原始Markdown
+        user_id=user.id,
+        room_id=room_id,
+        client_id=client_id,
+        content_html=content_html
+    )
+    db_session.add(message)
+    bump_chat_seq(room_id)
+    try:
+        db_session.commit()
+    except IntegrityError:
+        # 并发的重试请求先一步写入了同一 client_id
+        db_session.rollback()
+        existing = find_chat_message_by_client_id(user.id, client_id) if client_id else None
+        if existing is None:
+            raise
+        return serialize_chat_message(existing), False
+    return serialize_chat_message(message), True
+
+
+# 发送限流：按 RATE_LIMITS 中的 (每秒补充令牌数, 桶容量) 对每个用户、每个聊天室/分区各维护一个令牌桶，
+# RATE_LIMIT_OVERRIDES 可为个别用户或房间单独配置。桶状态保存在可替换的存储中：默认进程内存，
+# 多进程部署时通过 RATE_LIMIT_STORE（'模块:类名'）换成共享存储，只需实现同样的 consume 方法。
+# 一次操作涉及的多个桶（用户 + 房间）要么都扣一个令牌，要么都不扣。
+class MemoryRateLimitStore:
+    """进程内令牌桶存储，超过 max_keys 个桶时淘汰最久未用的（被淘汰的桶相当于重新装满）"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # {key: (tokens, updated)}
+        self._lock = threading.Lock()
+
+    def consume(self, buckets):
+        """buckets 为 [(key, rate, burst)]；每个桶都有令牌时各取一个，返回 (None, 0)，
+        否则一个都不取，返回 (第一个不足的 key, retry_after 秒)"""
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for key, rate, burst in buckets:
+                tokens, updated = self._buckets.pop(key, (burst, now))
+                levels.append(min(burst, tokens + (now - updated) * rate))
+            rejected, retry_after = None, 0
+            for (key, rate, _), tokens in zip(buckets, levels):
+                if tokens < 1:
+                    rejected, retry_after = key, (1 - tokens) / rate
+                    break
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens if rejected else tokens - 1, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return rejected, retry_after
+
+
+_rate_limit_store = None
+
+
+def get_rate_limit_store():
+    """返回当前限流存储，首次调用时按 RATE_LIMIT_STORE 创建"""
+    global _rate_limit_store
+    if _rate_limit_store is None:
+        path = app.config.get('RATE_LIMIT_STORE')
+        if path:
+            module_name, _, class_name = path.partition(':')
+            _rate_limit_store = getattr(importlib.import_module(module_name), class_name)()
+        else:
+            _rate_limit_store = MemoryRateLimitStore()
+    return _rate_limit_store
+
+
+def check_rate_limits(*targets):
+    """targets 为 (scope, ident)；全部未超限时各扣一个令牌并返回 None，否则不扣令牌，返回 rate_limited 详情
+
+    存储不可用时放行并记录错误，避免限流故障阻断发送。
+    """
+    buckets, scopes = [], {}
+    for scope, ident in targets:
+        overrides = (app.config.get('RATE_LIMIT_OVERRIDES') or {}).get(scope) or {}
+        limit = overrides[ident] if ident in overrides else (app.config.get('RATE_LIMITS') or {}).get(scope)
+        if limit:
+            key = f"{scope}:{ident}"
+            buckets.append((key, limit[0], limit[1]))
+            scopes[key] = scope
+    if not buckets:
+        return None
+    try:
+        rejected, retry_after = get_rate_limit_store().consume(buckets)
+    except Exception:
+        logger.exception(f"限流存储不可用，放行 {list(scopes)}")
+        return None
+    if rejected is None:
+        return None
+    return {'message': '操作过于频繁，请稍后再试', 'scope': scopes[rejected], 'retry_after': round(retry_after, 2)}
+
+
+def rate_limited_response(limited):
+    """把 rate_limited 详情转换为 HTTP 429 响应"""
+    response = jsonify(success=False, **limited)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(limited['retry_after'])))
+    return response
+
+
+def _resend_existing_message(payload):
+    """重试发送：不再保存和广播，只把已有消息回给发送者（REST 由调用方返回 payload）"""
+    if getattr(request, 'sid', None):
+        emit('message', payload)
+    return payload, None, None
+
+
+def send_chat_pipeline(user, room_id, content, client_id=None):
+    """Socket.IO 与 REST 共用的发送流程：校验、限流、过滤、保存、推送
+
+    返回 (payload, error, status)：成功时 error 为 None；失败时 status 为对应的 HTTP 状态码，
+    payload 为 None，被限流（429）时为 rate_limited 详情。
+    """
     try:
         room_id = int(room_id)
     except (TypeError, ValueError):
         room_id = None
+    content = (content or '').strip()
 
-    message = (message or '').strip()
+    if not room_id or not content:
+        return None, '参数错误', 400
 
-    if not room_id or not message:
-        return jsonify(success=False, message="参数错误"), 400
+    if not user_can_send_chat(user, room_id):
+        return None, '当前权限无法发送消息', 403
 
-    if not user_can_send_chat(current_user, room_id):
-        return jsonify(success=False, message="当前权限无法发送消息"), 403
+    # 内容长度限制
+    if len(content) > 2000:
+        return None, '消息过长', 400
 
-    # 保存到数据库
-    message_obj = ChatMessage(
-        content=message,
-        user_id=current_user.id,
-        room_id=room_id
+    # 重试发送先于限流处理：已保存过的消息直接返回，不消耗令牌
+    client_id = normalize_client_id(client_id)
+    existing = find_existing_chat_message(user, client_id) if client_id else None
+    if existing is not None:
+        return _resend_existing_message(existing)
+
+    limited = check_rate_limits(('chat_user', user.id), ('chat_room', room_id))
+    if limited:
+        limited['room_id'] = room_id
+        return limited, limited['message'], 429
+
+    # XSS基础防护与预渲染
+    content, rendered = prepare_content(content)
+
+    payload, created = persist_chat_message(room_id, user, content, client_id, rendered)
+    if not created:
+        return _resend_existing_message(payload)
+
+    queue_unread_delta('chat', room_id)
+    record_chat_message(room_id)
+    cache_chat_message(room_id, payload)
+    # 同步推送给长轮询/SSE 订阅者
+    publish_chat_message(room_id, payload)
+
+    # 推送给房间内所有 Socket.IO 连接（包括发送者）；payload 带 client_id，发送者据此把本地 pending 消息更新为服务器 id
+    socketio.emit('message', payload, to=f"room_{room_id}")
+    return payload, None, None
+
+
+@app.route('/api/chat/send', methods=['POST'])
+@login_required
+def send_chat_message():
+    """REST 发送消息（ll.py 与 WebSocket 不可用时的降级），返回完整消息"""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = request.form
+    payload, error, status = send_chat_pipeline(
+        current_user, data.get('room_id'), data.get('message', ''), data.get('client_id')
     )
-    db_session.add(message_obj)
-    db_session.commit()
-    
-    # 返回成功响应
-    return jsonify(success=True)
+    if status == 429:
+        return rate_limited_response(payload)
+    if error:
+        return jsonify(success=False, message=error), status
+    return jsonify(success=True, **payload)
 
 
 @app.route('/api/chat/<int:room_id>/messages/<int:message_id>', methods=['DELETE'])
@@ -758,74 +1833,474 @@ def api_delete_chat_message(room_id, message_id):
             else:
                 allowed = False
 
-        if not allowed:
-            return jsonify({'success': False, 'message': '权限不足'}), 403
+        if not allowed:
+            return jsonify({'success': False, 'message': '权限不足'}), 403
+
+        # 执行删除
+        db_session.delete(msg)
+        db_session.commit()
+        discard_cached_message(room_id, message_id)
+        logger.info(f"用户 {current_user.id} 删除了聊天室消息 {message_id} 在房间 {room_id}")
+        return jsonify({'success': True, 'message': '消息已删除'})
+    except Exception as e:
+        db_session.rollback()
+        logger.exception('删除聊天室消息时发生错误')
+        return jsonify({'success': False, 'message': '服务器错误'}), 500
+
+
+@app.route('/api/forum/reply/<int:reply_id>', methods=['DELETE'])
+@login_required
+def api_delete_forum_reply(reply_id):
+    """删除论坛回复：su 或管理员可以删除任意回复；777 可删除自己回复。"""
+    try:
+        reply = db_session.query(ForumReply).filter_by(id=reply_id).first()
+        if not reply:
+            return jsonify({'success': False, 'message': '回复未找到'}), 404
+
+        # 通过 ORM 关系获取关联主题（更可靠），并确保主题存在
+        thread = getattr(reply, 'thread', None)
+        if not thread:
+            # 如果关系未加载，尝试按 id 查询（兼容性处理）
+            thread = db_session.query(ForumThread).filter_by(id=reply.thread_id).first()
+        if not thread:
+            return jsonify({'success': False, 'message': '关联主题不存在'}), 400
+        section_id = thread.section_id
+
+        # 管理员快捷通过；get_forum_permission_value 已返回规范化值
+        if current_user.is_admin():
+            allowed = True
+        else:
+            perm = get_forum_permission_value(current_user, section_id)
+            if perm == 'su':
+                allowed = True
+            elif perm == '777' and reply.user_id == current_user.id:
+                allowed = True
+            else:
+                allowed = False
+
+        if not allowed:
+            return jsonify({'success': False, 'message': '权限不足'}), 403
+
+        # 删除回复并重算主题统计
+        db_session.delete(reply)
+        db_session.flush()
+        refresh_thread_reply_stats([thread.id])
+        db_session.commit()
+        logger.info(f"用户 {current_user.id} 删除了回复 {reply_id}")
+        return jsonify({'success': True, 'message': '回复已删除'})
+    except Exception as e:
+        db_session.rollback()
+        logger.exception('删除回复时发生错误')
+        return jsonify({'success': False, 'message': '服务器错误'}), 500
+
+
+@app.route('/api/online_count')
+@login_required
+def get_online_count():
+    """获取全局在线用户数（WebSocket 不可用时的轮询降级，同时作为心跳）"""
+    presence_touch(current_user.id)
+    return jsonify(count=presence_online_count())
+
+
+def get_visible_ids(user, scope):
+    """返回用户在 chat/forum 范围内可见的房间或分区 id；管理员返回 None 表示全部可见"""
+    if user.is_admin():
+        return None
+    view_perms = CHAT_VIEW_PERMISSIONS if scope == 'chat' else FORUM_VIEW_PERMISSIONS
+    return [target_id for target_id, perm in get_permission_snapshot(user)[scope].items() if perm in view_perms]
+
+
+def get_chat_unread_counts(user):
+    """未读数 = 聊天室当前序号（含写后队列中尚未提交的消息） - 用户最后查看时的序号"""
+    visible = get_visible_ids(user, 'chat')
+    query = db_session.query(
+        ChatRoom.id, func.coalesce(ChatRoom.message_seq, 0) - func.coalesce(ChatLastView.seen_seq, 0)
+    ).outerjoin(ChatLastView, and_(ChatLastView.room_id == ChatRoom.id, ChatLastView.user_id == user.id))
+    if visible is not None:
+        query = query.filter(ChatRoom.id.in_(visible))
+    pending = pending_chat_counts()
+    # 写入失败被丢弃的消息不会递增序号，结果可能略小于 0
+    return {room_id: max(0, count + pending.get(room_id, 0)) for room_id, count in query.all()}
+
+
+def get_forum_unread_counts(user):
+    """未读数 = 分区当前主题+回复序号 - 用户最后查看时的序号"""
+    visible = get_visible_ids(user, 'forum')
+    query = db_session.query(
+        ForumSection.id, func.coalesce(ForumSection.activity_seq, 0) - func.coalesce(ForumLastView.seen_seq, 0)
+    ).outerjoin(ForumLastView, and_(ForumLastView.section_id == ForumSection.id, ForumLastView.user_id == user.id))
+    if visible is not None:
+        query = query.filter(ForumSection.id.in_(visible))
+    return dict(query.all())
+
+
+def bump_chat_seq(room_id):
+    """新消息写入时递增聊天室序号（与插入处于同一事务）"""
+    db_session.execute(
+        update(ChatRoom).where(ChatRoom.id == room_id)
+        .values(message_seq=func.coalesce(ChatRoom.message_seq, 0) + 1)
+    )
+
+
+def bump_forum_seq(section_id):
+    """新主题或回复写入时递增分区序号（与插入处于同一事务）"""
+    db_session.execute(
+        update(ForumSection).where(ForumSection.id == section_id)
+        .values(activity_seq=func.coalesce(ForumSection.activity_seq, 0) + 1)
+    )
+
+
+def refresh_thread_reply_stats(thread_ids, session=None):
+    """删除回复后按剩余回复重新计算主题的 reply_count 与 last_reply_at（与删除处于同一事务）"""
+    if session is None:
+        session = db_session
+    thread_ids = [tid for tid in set(thread_ids) if tid is not None]
+    if not thread_ids:
+        return
+    replies = ForumReply.__table__
+    session.execute(
+        update(ForumThread).where(ForumThread.id.in_(thread_ids)).values(
+            reply_count=select(func.count(replies.c.id))
+            .where(replies.c.thread_id == ForumThread.id).scalar_subquery(),
+            last_reply_at=func.coalesce(
+                select(func.max(replies.c.timestamp))
+                .where(replies.c.thread_id == ForumThread.id).scalar_subquery(),
+                ForumThread.timestamp
+            )
+        ),
+        execution_options={'synchronize_session': False}
+    )
+
+
+# 在线状态服务：进程内记录每个用户的 Socket.IO 连接与最近活动时间。
+# 服务启动满 ONLINE_TIMEOUT 之前内存数据不完整，在线数回退到按 ONLINE_COUNT_CACHE_TTL 缓存的数据库统计
+_presence_sids = {}  # {user_id: set(sid)}
+_presence_seen = {}  # {user_id: 最近活动的 monotonic 时间}
+_presence_lock = threading.Lock()
+_presence_started_at = time.monotonic()
+_online_count_cache = {'value': None, 'expires': 0}
+# 待写回的 last_seen：{user_id: datetime}，由后台任务每 LAST_SEEN_FLUSH_INTERVAL 秒批量写入
+_last_seen_pending = {}
+
+
+def _buffer_last_seen(user_id):
+    """记录 last_seen 到内存缓冲并按需启动写回任务（调用方持有锁）"""
+    _last_seen_pending[user_id] = datetime.utcnow()
+    start_periodic_task('LAST_SEEN_FLUSH_INTERVAL', 5, flush_last_seen)
+
+
+def get_pending_last_seen():
+    """尚未写回数据库的 last_seen 快照，读取时应优先于数据库中的值"""
+    with _presence_lock:
+        return dict(_last_seen_pending)
+
+
+def flush_last_seen():
+    """把缓冲的 last_seen 用一条 UPDATE ... CASE 批量写回"""
+    with _presence_lock:
+        pending = dict(_last_seen_pending)
+        _last_seen_pending.clear()
+    if not pending:
+        return
+    items = list(pending.items())
+    try:
+        with engine.begin() as conn:
+            # 每个 id 占两个参数，分批避免超过 SQLite 参数上限
+            for start in range(0, len(items), 400):
+                chunk = dict(items[start:start + 400])
+                conn.execute(
+                    update(User).where(User.id.in_(list(chunk)))
+                    .values(last_seen=case(chunk, value=User.id))
+                )
+    except Exception:
+        # 写回失败时放回缓冲（保留更新的值），下次重试
+        with _presence_lock:
+            for user_id, seen in pending.items():
+                if _last_seen_pending.get(user_id, seen) <= seen:
+                    _last_seen_pending[user_id] = seen
+        raise
+
+
+
+
+def presence_connect(user_id, sid):
+    """登记一个新连接"""
+    with _presence_lock:
+        _presence_sids.setdefault(user_id, set()).add(sid)
+        _presence_seen[user_id] = time.monotonic()
+        _buffer_last_seen(user_id)
+        _ensure_presence_task()
+
+
+def presence_disconnect(user_id, sid):
+    """移除连接；用户没有其他连接时立即视为离线"""
+    with _presence_lock:
+        sids = _presence_sids.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del _presence_sids[user_id]
+                _presence_seen.pop(user_id, None)
+
+
+def presence_touch(user_id):
+    """记录一次活动（心跳、进入房间、登录、HTTP 轮询等）"""
+    with _presence_lock:
+        _presence_seen[user_id] = time.monotonic()
+        _buffer_last_seen(user_id)
+
+
+def presence_online_user_ids():
+    """返回当前在线的用户 id：有活跃连接，或最近 ONLINE_TIMEOUT 内有活动"""
+    cutoff = time.monotonic() - app.config.get('ONLINE_TIMEOUT', 300)
+    with _presence_lock:
+        for user_id in [uid for uid, seen in _presence_seen.items() if seen < cutoff and uid not in _presence_sids]:
+            del _presence_seen[user_id]
+        return set(_presence_sids) | set(_presence_seen)
+
+
+def count_online_users_from_db():
+    """按 last_seen 统计在线人数（含尚未写回的缓冲值），结果缓存 ONLINE_COUNT_CACHE_TTL 秒"""
+    now = time.monotonic()
+    if _online_count_cache['value'] is not None and now < _online_count_cache['expires']:
+        return _online_count_cache['value']
+    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
+    condition = User.last_seen >= cutoff_time
+    pending_ids = [user_id for user_id, seen in get_pending_last_seen().items() if seen >= cutoff_time]
+    if pending_ids:
+        condition = or_(condition, User.id.in_(pending_ids))
+    # 使用独立连接，后台任务和请求中都可以调用
+    with engine.connect() as conn:
+        value = conn.execute(select(func.count(User.id)).where(condition)).scalar() or 0
+    _online_count_cache.update(value=value, expires=now + app.config.get('ONLINE_COUNT_CACHE_TTL', 10))
+    return value
+
+
+def presence_online_count():
+    """全局在线人数"""
+    online = len(presence_online_user_ids())
+    if time.monotonic() - _presence_started_at < app.config.get('ONLINE_TIMEOUT', 300):
+        # 重启后尚未观察满一个在线窗口，之前活跃的用户只记录在数据库里
+        return max(online, count_online_users_from_db())
+    return online
+
+
+class RoomPresence:
+    """聊天室中的一个连接（按 sid 记录，进入房间时快照用户展示信息）"""
+    __slots__ = ('user_id', 'username', 'nickname', 'color', 'badge')
+
+    def __init__(self, user):
+        self.user_id = user.id
+        self.username = user.username
+        self.nickname = user.nickname or user.username
+        self.color = user.color
+        self.badge = user.badge
+
+    def to_dict(self):
+        return {
+            'id': self.user_id,
+            'username': self.username,
+            'nickname': self.nickname,
+            'color': self.color,
+            'badge': self.badge
+        }
+
+
+# 聊天室在线名单：{room_id: {sid: RoomPresence}}，以及反向索引 {sid: set(room_id)} 用于断开时清理
+_room_presence = {}
+_sid_rooms = {}
+# 待推送的名单变化：{room_id: {user_id: RoomPresence（进入）或 None（离开）}}，同一间隔内进出会相互抵消
+_presence_diffs = {}
+_last_pushed_online_count = None
+
+
+def _room_has_user(room_id, user_id):
+    return any(entry.user_id == user_id for entry in _room_presence.get(room_id, {}).values())
+
+
+def _ensure_presence_task():
+    """首次有连接时启动在线状态推送任务（调用方持有锁）"""
+    start_periodic_task('PRESENCE_PUSH_INTERVAL', 2, flush_presence_diffs)
+
+
+def _queue_presence_diff(room_id, user_id, entry):
+    """登记用户进入（entry）或离开（None）房间（调用方持有锁）"""
+    pending = _presence_diffs.setdefault(room_id, {})
+    if user_id in pending and (pending[user_id] is None) != (entry is None):
+        # 与上一次未推送的变化方向相反，两者抵消
+        del pending[user_id]
+        if not pending:
+            del _presence_diffs[room_id]
+    else:
+        pending[user_id] = entry
+
+
+def presence_join_room(room_id, sid, user):
+    """登记连接进入房间；同一 sid 重复进入只会覆盖原记录"""
+    entry = RoomPresence(user)
+    with _presence_lock:
+        if not _room_has_user(room_id, user.id):
+            _queue_presence_diff(room_id, user.id, entry)
+        _room_presence.setdefault(room_id, {})[sid] = entry
+        _sid_rooms.setdefault(sid, set()).add(room_id)
+
+
+def presence_leave_room(room_id, sid):
+    """登记连接离开房间；未进入过也可安全调用"""
+    with _presence_lock:
+        _discard_room_presence(room_id, sid)
+
+
+def presence_drop_sid(sid):
+    """连接断开时移除它所在的全部房间记录"""
+    with _presence_lock:
+        for room_id in list(_sid_rooms.get(sid, ())):
+            _discard_room_presence(room_id, sid)
+
+
+def _discard_room_presence(room_id, sid):
+    """移除一条记录并清理空容器（调用方持有锁）"""
+    members = _room_presence.get(room_id)
+    if members is not None:
+        entry = members.pop(sid, None)
+        if entry is not None and not _room_has_user(room_id, entry.user_id):
+            # 该用户在房间内的最后一个连接离开
+            _queue_presence_diff(room_id, entry.user_id, None)
+        if not members:
+            del _room_presence[room_id]
+    rooms = _sid_rooms.get(sid)
+    if rooms is not None:
+        rooms.discard(room_id)
+        if not rooms:
+            del _sid_rooms[sid]
+
+
+def get_online_users(room_id):
+    """获取指定房间的在线用户（同一用户多个连接只返回一次）"""
+    with _presence_lock:
+        members = list(_room_presence.get(room_id, {}).values())
+    users = {}
+    for entry in members:
+        users.setdefault(entry.user_id, entry)
+    return [entry.to_dict() for entry in users.values()]
+
+
+def flush_presence_diffs():
+    """把合并后的名单变化推送给各房间，并在全局在线人数变化时广播"""
+    global _last_pushed_online_count
+    with _presence_lock:
+        pending = dict(_presence_diffs)
+        _presence_diffs.clear()
+    for room_id, changes in pending.items():
+        socketio.emit('presence_diff', {
+            'room_id': room_id,
+            'joined': [entry.to_dict() for entry in changes.values() if entry is not None],
+            'left': [user_id for user_id, entry in changes.items() if entry is None]
+        }, to=f"room_{room_id}")
+
+    online_count = presence_online_count()
+    if online_count != _last_pushed_online_count:
+        _last_pushed_online_count = online_count
+        socketio.emit('global_online_count', {'count': online_count})
+
+
+def user_channel(user_id):
+    """用户个人 Socket.IO 频道名，用户的所有连接都会加入"""
+    return f"user_{user_id}"
+
+
+# 粉丝索引：{被关注者 id: set(关注者 id)}，按需从数据库加载，关注关系变化时同步更新
+_follower_index = {}
+_follower_index_lock = threading.Lock()
+
+
+def get_follower_ids(user_id):
+    """返回关注该用户的用户 id 集合（走 ix_user_follows_followed 索引，结果常驻内存）"""
+    with _follower_index_lock:
+        followers = _follower_index.get(user_id)
+        if followers is not None:
+            return set(followers)
+    followers = {
+        row[0] for row in db_session.query(UserFollow.follower_id).filter(UserFollow.followed_id == user_id)
+    }
+    with _follower_index_lock:
+        _follower_index.setdefault(user_id, followers)
+    return set(followers)
+
+
+def follower_index_update(follower_id, followed_id, following):
+    """关注/取消关注提交后更新索引；未加载的用户等下次使用时再加载"""
+    with _follower_index_lock:
+        followers = _follower_index.get(followed_id)
+        if followers is not None:
+            if following:
+                followers.add(follower_id)
+            else:
+                followers.discard(follower_id)
+
 
-        # 执行删除
-        db_session.delete(msg)
-        db_session.commit()
-        logger.info(f"用户 {current_user.id} 删除了聊天室消息 {message_id} 在房间 {room_id}")
-        return jsonify({'success': True, 'message': '消息已删除'})
-    except Exception as e:
-        db_session.rollback()
-        logger.exception('删除聊天室消息时发生错误')
-        return jsonify({'success': False, 'message': '服务器错误'}), 500
+def invalidate_follower_index():
+    """删除用户等批量变化后清空索引"""
+    with _follower_index_lock:
+        _follower_index.clear()
 
 
-@app.route('/api/forum/reply/<int:reply_id>', methods=['DELETE'])
-@login_required
-def api_delete_forum_reply(reply_id):
-    """删除论坛回复：su 或管理员可以删除任意回复；777 可删除自己回复。"""
-    try:
-        reply = db_session.query(ForumReply).filter_by(id=reply_id).first()
-        if not reply:
-            return jsonify({'success': False, 'message': '回复未找到'}), 404
+def notify_followers(event, user, room_id):
+    """只向关注该用户的人的个人频道推送进出房间通知"""
+    payload = {
+        'user_id': user.id,
+        'username': user.username,
+        'nickname': user.nickname or user.username,
+        'room_id': room_id
+    }
+    for follower_id in get_follower_ids(user.id):
+        socketio.emit(event, payload, to=user_channel(follower_id))
 
-        # 通过 ORM 关系获取关联主题（更可靠），并确保主题存在
-        thread = getattr(reply, 'thread', None)
-        if not thread:
-            # 如果关系未加载，尝试按 id 查询（兼容性处理）
-            thread = db_session.query(ForumThread).filter_by(id=reply.thread_id).first()
-        if not thread:
-            return jsonify({'success': False, 'message': '关联主题不存在'}), 400
-        section_id = thread.section_id
 
-        # 管理员快捷通过；get_forum_permission_value 已返回规范化值
-        if current_user.is_admin():
-            allowed = True
-        else:
-            perm = get_forum_permission_value(current_user, section_id)
-            if perm == 'su':
-                allowed = True
-            elif perm == '777' and reply.user_id == current_user.id:
-                allowed = True
-            else:
-                allowed = False
+# 待推送的未读增量：{'chat': {room_id: n}, 'forum': {section_id: n}}，按 UNREAD_PUSH_INTERVAL 合并发送
+_unread_pending = {'chat': {}, 'forum': {}}
+_unread_lock = threading.Lock()
 
-        if not allowed:
-            return jsonify({'success': False, 'message': '权限不足'}), 403
 
-        # 删除回复
-        db_session.delete(reply)
-        db_session.commit()
-        logger.info(f"用户 {current_user.id} 删除了回复 {reply_id}")
-        return jsonify({'success': True, 'message': '回复已删除'})
-    except Exception as e:
-        db_session.rollback()
-        logger.exception('删除回复时发生错误')
-        return jsonify({'success': False, 'message': '服务器错误'}), 500
+def queue_unread_delta(scope, target_id, delta=1):
+    """登记一次未读增量，由后台任务合并后推送给可见该房间/分区的用户"""
+    with _unread_lock:
+        bucket = _unread_pending[scope]
+        bucket[target_id] = bucket.get(target_id, 0) + delta
+    start_periodic_task('UNREAD_PUSH_INTERVAL', 1, flush_unread_deltas)
 
 
-@app.route('/api/online_count')
-@login_required
-def get_online_count():
-    """获取全局在线用户数"""
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
-    
-    return jsonify(count=online_count)
+def flush_unread_deltas():
+    """把合并后的未读增量推送到每个可见用户的个人频道"""
+    with _unread_lock:
+        pending = {scope: dict(bucket) for scope, bucket in _unread_pending.items()}
+        for bucket in _unread_pending.values():
+            bucket.clear()
+    if not any(pending.values()):
+        return
+
+    payloads = {}
+    # 后台任务不在请求上下文中，使用独立连接避免干扰请求的 db_session
+    with engine.connect() as conn:
+        admin_ids = [row[0] for row in conn.execute(select(User.id).where(User.role == 'admin'))]
+        for scope, model, target_col, view_perms in (
+            ('chat', ChatPermission, ChatPermission.room_id, CHAT_VIEW_PERMISSIONS),
+            ('forum', ForumPermission, ForumPermission.section_id, FORUM_VIEW_PERMISSIONS),
+        ):
+            deltas = pending[scope]
+            if not deltas:
+                continue
+            rows = conn.execute(
+                select(model.user_id, target_col, model.perm).where(target_col.in_(list(deltas)))
+            )
+            for user_id, target_id, perm in rows:
+                if normalize_permission_value(perm) in view_perms:
+                    payloads.setdefault(user_id, {'chat': {}, 'forum': {}})[scope][target_id] = deltas[target_id]
+            for user_id in admin_ids:
+                payloads.setdefault(user_id, {'chat': {}, 'forum': {}})[scope].update(deltas)
+
+    for user_id, payload in payloads.items():
+        socketio.emit('unread_delta', payload, to=user_channel(user_id))
 
 
 @app.route('/api/last_views/unread_counts')
@@ -833,39 +2308,8 @@ def get_online_count():
 def api_unread_counts():
     """返回用户在可访问的聊天室和贴吧分区上的未读数量映射"""
     try:
-        chat_counts = {}
-        forum_counts = {}
-
-        # 聊天室
-        rooms = db_session.query(ChatRoom).all()
-        for room in rooms:
-            if get_chat_permission_value(current_user, room.id) == 'Null':
-                continue
-            last = db_session.query(ChatLastView).filter_by(user_id=current_user.id, room_id=room.id).first()
-            if last:
-                cnt = db_session.query(ChatMessage).filter(ChatMessage.room_id == room.id, ChatMessage.timestamp > last.last_view).count()
-            else:
-                cnt = db_session.query(ChatMessage).filter_by(room_id=room.id).count()
-            chat_counts[room.id] = cnt
-
-        # 贴吧分区
-        sections = db_session.query(ForumSection).all()
-        for section in sections:
-            if get_forum_permission_value(current_user, section.id) == 'Null':
-                continue
-            last = db_session.query(ForumLastView).filter_by(user_id=current_user.id, section_id=section.id).first()
-            if last:
-                last_time = last.last_view
-                cnt_threads = db_session.query(ForumThread).filter(ForumThread.section_id == section.id, ForumThread.timestamp > last_time).count()
-                # 回复：需要关联 thread -> section
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id)\
-                    .filter(ForumThread.section_id == section.id, ForumReply.timestamp > last_time).count()
-            else:
-                cnt_threads = db_session.query(ForumThread).filter_by(section_id=section.id).count()
-                cnt_replies = db_session.query(ForumReply).join(ForumThread, ForumReply.thread_id == ForumThread.id)\
-                    .filter(ForumThread.section_id == section.id).count()
-            forum_counts[section.id] = cnt_threads + cnt_replies
-
+        chat_counts = get_chat_unread_counts(current_user)
+        forum_counts = get_forum_unread_counts(current_user)
         return jsonify(success=True, chat=chat_counts, forum=forum_counts)
     except Exception as e:
         logger.exception('计算未读数时发生错误')
@@ -913,6 +2357,7 @@ def api_follows():
         follow = UserFollow(follower_id=current_user.id, followed_id=target.id)
         db_session.add(follow)
         db_session.commit()
+        follower_index_update(current_user.id, target.id, True)
         return jsonify(success=True, message='关注成功', user={'id': target.id, 'username': target.username, 'nickname': target.nickname})
     except Exception as e:
         db_session.rollback()
@@ -929,6 +2374,7 @@ def api_unfollow(followed_id):
             return jsonify(success=False, message='未找到关注关系'), 404
         db_session.delete(rel)
         db_session.commit()
+        follower_index_update(current_user.id, followed_id, False)
         return jsonify(success=True, message='已取消关注')
     except Exception as e:
         db_session.rollback()
@@ -964,6 +2410,13 @@ def forum_index():
 
     return render_template('forum/index.html', sections=visible_sections, section_permissions=section_permissions)
 
+# 分区页可选排序方式
+FORUM_SECTION_SORTS = {
+    'latest': ForumThread.timestamp,
+    'active': ForumThread.last_reply_at,
+}
+
+
 @app.route('/forum/section/<int:section_id>')
 @login_required
 def forum_section(section_id):
@@ -973,42 +2426,141 @@ def forum_section(section_id):
     permission = get_forum_permission_value(current_user, section_id)
     if permission == 'Null':
         abort(403)
-    threads = db_session.query(ForumThread).filter_by(section_id=section_id)\
-        .order_by(ForumThread.timestamp.desc()).all()
     # 记录用户最后查看该分区的时间（用于未读统计）
     try:
         last = db_session.query(ForumLastView).filter_by(user_id=current_user.id, section_id=section_id).first()
         now = datetime.utcnow()
+        seen_seq = select(ForumSection.activity_seq).where(ForumSection.id == section_id).scalar_subquery()
         if last:
             last.last_view = now
+            last.seen_seq = seen_seq
         else:
-            db_session.add(ForumLastView(user_id=current_user.id, section_id=section_id, last_view=now))
+            db_session.add(ForumLastView(
+                user_id=current_user.id, section_id=section_id, last_view=now, seen_seq=seen_seq
+            ))
         db_session.commit()
     except Exception:
         db_session.rollback()
 
+    # 分页与排序：latest 按发帖时间，active 按最后回复时间，均走 (section_id, 排序列) 索引
+    sort = request.args.get('sort', 'latest')
+    if sort not in FORUM_SECTION_SORTS:
+        sort = 'latest'
+    per_page = app.config.get('FORUM_THREADS_PER_PAGE', 20)
+    total = db_session.query(func.count(ForumThread.id)).filter(ForumThread.section_id == section_id).scalar() or 0
+    pages = max(1, (total + per_page - 1) // per_page)
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+
+    # 在提交之后加载，避免提交使已加载的主题过期而在渲染时逐条刷新
+    threads = db_session.query(ForumThread).options(joinedload(ForumThread.user))\
+        .filter(ForumThread.section_id == section_id)\
+        .order_by(FORUM_SECTION_SORTS[sort].desc(), ForumThread.id.desc())\
+        .offset((page - 1) * per_page).limit(per_page).all()
+
     return render_template(
         'forum/section.html',
         section=section,
         threads=threads,
+        sort=sort,
+        page=page,
+        pages=pages,
         section_permission=permission,
         can_post=permission in FORUM_POST_PERMISSIONS
     )
 
+def query_reply_page(thread_id, before_id=None, after_id=None, limit=50):
+    """按 (thread_id, id) 游标查询一页回复，返回 (replies, prev, next, has_more)
+
+    after_id 为向后翻页（after_id=0 即从第一条开始）；否则从 before_id（缺省为末尾）向前取。
+    prev 为还有更早回复时的 before_id，next 为还有更新回复时的 after_id，没有时为 None。
+    """
+    query = db_session.query(ForumReply).options(joinedload(ForumReply.user))\
+        .filter(ForumReply.thread_id == thread_id)
+    if after_id is not None:
+        rows = query.filter(ForumReply.id > after_id).order_by(ForumReply.id.asc()).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        replies = rows[:limit]
+        has_older = after_id > 0 and bool(replies)
+    else:
+        if before_id is not None:
+            query = query.filter(ForumReply.id < before_id)
+        rows = query.order_by(ForumReply.id.desc()).limit(limit + 1).all()
+        has_older = len(rows) > limit
+        replies = list(reversed(rows[:limit]))
+        has_more = before_id is not None
+    prev_cursor = replies[0].id if replies and has_older else None
+    next_cursor = replies[-1].id if replies and has_more else None
+    return replies, prev_cursor, next_cursor, has_more
+
+
+def serialize_forum_reply(reply, section_permission):
+    """把回复转换为返回给客户端的字典（原始Markdown内容，开启服务端渲染时附带 html）"""
+    return {
+        'id': reply.id,
+        'content': reply.content,  # 原始Markdown内容
+        'html': render_stored_content(reply.content),
+        'timestamp': reply.timestamp.isoformat(),
+        'user_id': reply.user_id,
+        'username': reply.user.username,
+        'nickname': reply.user.nickname or reply.user.username,
+        'color': reply.user.color,
+        'badge': reply.user.badge,
+        'can_delete': section_permission == 'su' or (section_permission == '777' and reply.user_id == current_user.id)
+    }
+
+
+@app.route('/api/forum/thread/<int:thread_id>/replies')
+@login_required
+def forum_thread_replies(thread_id):
+    """分页获取主题回复（基于 (thread_id, id) 索引的游标分页）
+
+    参数：after_id 向后加载更新的回复；before_id 向前加载更早的回复；latest=1 获取最后一页。
+    """
+    thread = db_session.query(ForumThread).get(thread_id)
+    if thread is None:
+        return jsonify(success=False, message='帖子不存在'), 404
+    section_permission = get_forum_permission_value(current_user, thread.section_id)
+    if section_permission == 'Null':
+        return jsonify(success=False, message='无权限访问此帖子'), 403
+
+    limit = min(max(request.args.get('limit', app.config.get('FORUM_REPLIES_PER_PAGE', 50), type=int), 1), 100)
+    after_id = request.args.get('after_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    if after_id is None and before_id is None and request.args.get('latest', type=int) != 1:
+        after_id = 0
+    replies, prev_cursor, next_cursor, has_more = query_reply_page(thread_id, before_id, after_id, limit)
+    return jsonify(
+        success=True,
+        replies=[serialize_forum_reply(reply, section_permission) for reply in replies],
+        prev=prev_cursor,
+        next=next_cursor,
+        has_more=has_more
+    )
+
+
 @app.route('/forum/thread/<int:thread_id>')
 @login_required
 def forum_thread(thread_id):
-    thread = db_session.query(ForumThread).get(thread_id)
+    thread = db_session.query(ForumThread).options(joinedload(ForumThread.user))\
+        .filter(ForumThread.id == thread_id).first()
     if thread is None:
         abort(404)
     section_permission = get_forum_permission_value(current_user, thread.section_id)
     if section_permission == 'Null':
         abort(403)
-    replies = thread.replies.order_by(ForumReply.timestamp.asc()).all()
+    # 默认从第一条回复开始；latest=1 直接取最后一页，不从头扫描
+    latest = request.args.get('latest', type=int) == 1
+    limit = app.config.get('FORUM_REPLIES_PER_PAGE', 50)
+    if latest:
+        replies, prev_cursor, next_cursor, _ = query_reply_page(thread_id, limit=limit)
+    else:
+        replies, prev_cursor, next_cursor, _ = query_reply_page(thread_id, after_id=0, limit=limit)
     return render_template(
         'forum/thread.html',
         thread=thread,
         replies=replies,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         section_permission=section_permission,
         can_reply=section_permission in FORUM_POST_PERMISSIONS
     )
@@ -1072,17 +2624,27 @@ def new_post(section_id):
         if not content or len(content) > 10000:
             return jsonify(success=False, message="内容不能为空且不超过10000字符"), 400
         
+        limited = check_rate_limits(('forum_user', current_user.id), ('forum_section', section_id))
+        if limited:
+            return rate_limited_response(limited)
+        
         # XSS基础防护
-        content = sanitize_content(content)
+        content, _ = prepare_content(content)
         
+        now = datetime.utcnow()
         thread = ForumThread(
             title=title,
             content=content,  # 存储原始Markdown
+            timestamp=now,
             user_id=current_user.id,
-            section_id=section_id
+            section_id=section_id,
+            reply_count=0,
+            last_reply_at=now
         )
         db_session.add(thread)
+        bump_forum_seq(section_id)
         db_session.commit()
+        queue_unread_delta('forum', section_id)
         
         log_admin_action(f"用户创建新帖: {current_user.username} - {title}")
         return redirect(url_for('forum_thread', thread_id=thread.id))
@@ -1102,9 +2664,6 @@ def reply_post():
     if not content or len(content) > 5000:
         return jsonify(success=False, message="内容不能为空且不超过5000字符"), 400
     
-    # XSS基础防护
-    content = sanitize_content(content)
-    
     thread = db_session.query(ForumThread).get(thread_id)
     if not thread:
         return jsonify(success=False, message="帖子不存在"), 404
@@ -1112,13 +2671,29 @@ def reply_post():
     if not user_can_post_forum(current_user, thread.section_id):
         return jsonify(success=False, message="当前权限无法回复"), 403
     
+    limited = check_rate_limits(('forum_user', current_user.id), ('forum_section', thread.section_id))
+    if limited:
+        return rate_limited_response(limited)
+    
+    # XSS基础防护与预渲染
+    content, rendered = prepare_content(content)
+    
+    now = datetime.utcnow()
     reply = ForumReply(
         content=content,  # 存储原始Markdown
+        timestamp=now,
         user_id=current_user.id,
         thread_id=thread_id
     )
     db_session.add(reply)
+    db_session.execute(
+        update(ForumThread).where(ForumThread.id == thread_id)
+        .values(reply_count=func.coalesce(ForumThread.reply_count, 0) + 1, last_reply_at=now),
+        execution_options={'synchronize_session': False}
+    )
+    bump_forum_seq(thread.section_id)
     db_session.commit()
+    queue_unread_delta('forum', thread.section_id)
     
     log_admin_action(f"用户回复帖子: {current_user.username} - 帖子ID: {thread_id}")
     # 只返回原始内容，前端负责渲染
@@ -1131,9 +2706,84 @@ def reply_post():
         color=current_user.color,
         badge=current_user.badge,
         timestamp=reply.timestamp.isoformat(),
-        content=reply.content  # 原始Markdown
+        content=reply.content,  # 原始Markdown
+        html=rendered
     )
 
+# 仪表盘指标：计数类指标由后台任务按 METRICS_REFRESH_INTERVAL 刷新，在线人数与消息速率实时读取，
+# 管理页与系统信息接口只读取内存快照
+_metrics = {}
+_metrics_lock = threading.Lock()
+_room_message_times = {}  # {room_id: deque(最近一分钟内的消息时间戳)}
+
+
+def get_database_size():
+    """返回 SQLite 数据库文件（含 WAL）大小（字节）；非 SQLite 返回 None"""
+    if engine.url.get_backend_name() != 'sqlite' or not engine.url.database:
+        return None
+    size = 0
+    for path in (engine.url.database, engine.url.database + '-wal'):
+        if os.path.exists(path):
+            size += os.path.getsize(path)
+    return size
+
+
+def refresh_dashboard_metrics():
+    """重新统计计数类指标并更新快照"""
+    # 后台任务不在请求上下文中，使用独立连接
+    with engine.connect() as conn:
+        snapshot = {
+            'user_count': conn.execute(select(func.count(User.id))).scalar() or 0,
+            'chat_messages_count': conn.execute(select(func.count(ChatMessage.id))).scalar() or 0,
+            'forum_posts_count': (conn.execute(select(func.count(ForumThread.id))).scalar() or 0)
+                + (conn.execute(select(func.count(ForumReply.id))).scalar() or 0),
+        }
+    snapshot['database_size'] = get_database_size()
+    snapshot['refreshed_at'] = datetime.utcnow()
+    with _metrics_lock:
+        _metrics.update(snapshot)
+
+
+def record_chat_message(room_id):
+    """记录一条新消息用于每分钟消息速率统计"""
+    now = time.monotonic()
+    with _metrics_lock:
+        times = _room_message_times.setdefault(room_id, deque())
+        times.append(now)
+        while times and times[0] < now - 60:
+            times.popleft()
+
+
+def get_message_rates():
+    """返回 {room_id: 最近一分钟消息数}，顺带清理已过期的时间戳"""
+    cutoff = time.monotonic() - 60
+    rates = {}
+    with _metrics_lock:
+        for room_id in list(_room_message_times):
+            times = _room_message_times[room_id]
+            while times and times[0] < cutoff:
+                times.popleft()
+            if times:
+                rates[room_id] = len(times)
+            else:
+                del _room_message_times[room_id]
+    return rates
+
+
+def get_dashboard_metrics():
+    """返回仪表盘指标快照；首次调用时同步统计一次并启动后台刷新任务"""
+    with _metrics_lock:
+        ready = bool(_metrics)
+    start_periodic_task('METRICS_REFRESH_INTERVAL', 60, refresh_dashboard_metrics)
+    if not ready:
+        refresh_dashboard_metrics()
+    with _metrics_lock:
+        metrics = dict(_metrics)
+    metrics['online_count'] = presence_online_count()
+    metrics['messages_per_minute'] = get_message_rates()
+    return metrics
+
+
 # 管理相关路由
 @app.route('/admin')
 @login_required
@@ -1141,11 +2791,16 @@ def admin_index():
     if not current_user.is_admin():  # 只有管理员才能访问
         abort(403)
     
-    # 获取统计信息
-    user_count = db_session.query(User).count()
-    online_count = 1  # 简化实现，实际应查询最近活动的用户
-    chat_messages_count = db_session.query(ChatMessage).count()
-    forum_posts_count = db_session.query(ForumThread).count() + db_session.query(ForumReply).count()
+    # 获取统计信息（来自内存快照，不做全表 COUNT）
+    metrics = get_dashboard_metrics()
+    rates = metrics['messages_per_minute']
+    room_names = dict(
+        db_session.query(ChatRoom.id, ChatRoom.name).filter(ChatRoom.id.in_(list(rates))).all()
+    ) if rates else {}
+    room_rates = sorted(
+        ((room_names.get(room_id, f'#{room_id}'), count) for room_id, count in rates.items()),
+        key=lambda item: item[1], reverse=True
+    )
     
     # 获取系统信息
     python_version = sys.version.split()[0]
@@ -1156,10 +2811,13 @@ def admin_index():
     recent_logs = get_recent_logs(10)
     
     return render_template('admin/index.html',
-                         user_count=user_count,
-                         online_count=online_count,
-                         chat_messages_count=chat_messages_count,
-                         forum_posts_count=forum_posts_count,
+                         user_count=metrics['user_count'],
+                         online_count=metrics['online_count'],
+                         chat_messages_count=metrics['chat_messages_count'],
+                         forum_posts_count=metrics['forum_posts_count'],
+                         database_size=metrics['database_size'],
+                         metrics_refreshed_at=metrics['refreshed_at'],
+                         room_rates=room_rates,
                          python_version=python_version,
                          flask_version=flask_version,
                          database_path=database_path,
@@ -1172,7 +2830,7 @@ def user_management():
         abort(403)
     
     users = db_session.query(User).all()
-    return render_template('admin/users.html', users=users)
+    return render_template('admin/users.html', users=users, pending_last_seen=get_pending_last_seen())
 
 @app.route('/admin/chat')
 @login_required
@@ -1189,59 +2847,17 @@ def forum_management():
     if not current_user.is_admin():
         abort(403)
     
-    sections = db_session.query(ForumSection).all()
-
-    # 为了避免在模板中对 SQLAlchemy 的动态关系调用 len()/count 导致错误，
-    # 在后端预计算每个分区的主题数和回复数，并传递到模板。
-    sections_data = []
-    for section in sections:
-        threads_obj = section.threads
-        # 获取线程列表（兼容 dynamic relationship 或 InstrumentedList）
-        try:
-            if hasattr(threads_obj, 'all') and callable(getattr(threads_obj, 'all')):
-                threads_list = threads_obj.all()
-            else:
-                threads_list = list(threads_obj)
-        except Exception:
-            try:
-                threads_list = list(threads_obj)
-            except Exception:
-                threads_list = []
-
-        thread_count = 0
-        reply_count = 0
-        try:
-            thread_count = len(threads_list)
-        except Exception:
-            # 兜底：尝试调用 count()，若不是参数类型的 count 则会抛出 TypeError
-            try:
-                thread_count = threads_obj.count()
-            except Exception:
-                thread_count = 0
-
-        for thread in threads_list:
-            replies_obj = getattr(thread, 'replies', [])
-            try:
-                if hasattr(replies_obj, 'all') and callable(getattr(replies_obj, 'all')):
-                    replies_list = replies_obj.all()
-                else:
-                    replies_list = list(replies_obj)
-            except Exception:
-                try:
-                    replies_list = list(replies_obj)
-                except Exception:
-                    replies_list = []
-            try:
-                reply_count += len(replies_list)
-            except Exception:
-                reply_count += 0
-
-        sections_data.append({
-            'section': section,
-            'thread_count': thread_count,
-            'reply_count': reply_count,
-            'threads_list': threads_list
-        })
+    # 一次 GROUP BY 得到每个分区的主题数与回复数（回复数取主题上的冗余 reply_count），不加载任何主题
+    rows = db_session.query(
+        ForumSection,
+        func.count(ForumThread.id),
+        func.coalesce(func.sum(ForumThread.reply_count), 0)
+    ).outerjoin(ForumThread, ForumThread.section_id == ForumSection.id)\
+        .group_by(ForumSection.id).order_by(ForumSection.id).all()
+    sections_data = [
+        {'section': section, 'thread_count': thread_count, 'reply_count': reply_count}
+        for section, thread_count, reply_count in rows
+    ]
 
     return render_template('admin/forum.html', sections=sections_data)
 
@@ -1460,9 +3076,17 @@ def get_system_info():
         except ImportError:
             memory_usage = "psutil未安装"
         
+        metrics = get_dashboard_metrics()
         return jsonify({
             'success': True,
             'memory_usage': memory_usage,
+            'user_count': metrics['user_count'],
+            'online_count': metrics['online_count'],
+            'chat_messages_count': metrics['chat_messages_count'],
+            'forum_posts_count': metrics['forum_posts_count'],
+            'database_size': metrics['database_size'],
+            'messages_per_minute': metrics['messages_per_minute'],
+            'metrics_refreshed_at': metrics['refreshed_at'].isoformat(),
             'server_time': datetime.now().isoformat(),
             'python_version': sys.version,
             'flask_version': '2.3.2'
@@ -1503,6 +3127,7 @@ def restart_server():
         # 在新线程中重启服务器，给客户端响应
         def restart():
             time.sleep(2)  # 等待响应发送
+            flush_buffers_on_exit()  # os._exit 不会触发 atexit
             os._exit(0)  # 强制退出，由调试模式自动重启
         
         threading.Thread(target=restart).start()
@@ -1660,6 +3285,7 @@ def shutdown_server():
         # 在新线程中关闭服务器
         def shutdown():
             time.sleep(2)
+            flush_buffers_on_exit()  # os._exit 不会触发 atexit
             os._exit(0)
         
         threading.Thread(target=shutdown).start()
@@ -1692,6 +3318,7 @@ def update_user(user_id):
             user.badge = data['badge']
         
         db_session.commit()
+        invalidate_recent_messages()
         log_admin_action(f"更新了用户 {user.username} 的信息")
         return jsonify(success=True, message="用户信息更新成功")
     except Exception as e:
@@ -1732,8 +3359,13 @@ def remove_user_and_related(user_id, session=None):
         # 删除用户相关数据
         # - 消息、帖子、回复
         session.query(ChatMessage).filter_by(user_id=user_id).delete()
+        # 记录该用户回复过的主题，删除后重算这些主题的回复统计
+        replied_thread_ids = [
+            row[0] for row in session.query(ForumReply.thread_id).filter_by(user_id=user_id).distinct()
+        ]
         session.query(ForumThread).filter_by(user_id=user_id).delete()
         session.query(ForumReply).filter_by(user_id=user_id).delete()
+        refresh_thread_reply_stats(replied_thread_ids, session)
         # - 权限（聊天室/贴吧）
         session.query(ChatPermission).filter_by(user_id=user_id).delete()
         session.query(ForumPermission).filter_by(user_id=user_id).delete()
@@ -1746,6 +3378,9 @@ def remove_user_and_related(user_id, session=None):
         username = user.username
         session.delete(user)
         session.commit()
+        invalidate_permission_snapshot(user_id)
+        invalidate_recent_messages()
+        invalidate_follower_index()
         return True, username
     except Exception as e:
         session.rollback()
@@ -1782,6 +3417,7 @@ def update_user_role(user_id):
                 perm.perm = 'Null'
 
         db_session.commit()
+        invalidate_permission_snapshot(user.id)
 
         if new_role == 'admin':
             grant_su_to_admins()
@@ -1887,6 +3523,7 @@ def update_user_permissions(user_id):
                 db_session.add(ForumPermission(user_id=user.id, section_id=target_id, perm=perm_value))
 
     db_session.commit()
+    invalidate_permission_snapshot(user.id)
     log_admin_action(f"管理员 {current_user.username} 更新用户 {user.username} 的 {scope} 权限")
     return jsonify(success=True, message="权限已更新", perm=perm_value)
 
@@ -2048,6 +3685,7 @@ def delete_chat_room(room_id):
         room_name = room.name
         db_session.delete(room)
         db_session.commit()
+        invalidate_recent_messages(room_id)
 
         log_admin_action(f"删除了聊天室: {room_name}")
         return jsonify(success=True, message=f"聊天室 {room_name} 删除成功")
@@ -2079,6 +3717,7 @@ def delete_chat_messages():
 
         deleted_count = query.delete()
         db_session.commit()
+        invalidate_recent_messages(room_id or None)
 
         log_admin_action(f"清空聊天消息: {deleted_count} 条消息被删除")
         return jsonify(success=True, message=f"成功删除 {deleted_count} 条聊天消息")
@@ -2175,6 +3814,34 @@ def create_forum_section():
         return jsonify({'success': False, 'message': f"创建贴吧分区失败: {str(e)}"}), 500
 
 
+@app.route('/api/admin/forum/sections/<int:section_id>/threads', methods=['GET'])
+@login_required
+def admin_section_threads(section_id):
+    """按需分页获取分区主题列表（管理页展开分区时调用）"""
+    if not current_user.is_admin():
+        return jsonify(success=False, message="权限不足"), 403
+
+    per_page = app.config.get('FORUM_THREADS_PER_PAGE', 20)
+    page = max(request.args.get('page', 1, type=int), 1)
+    total = db_session.query(func.count(ForumThread.id)).filter(ForumThread.section_id == section_id).scalar() or 0
+    threads = db_session.query(ForumThread).options(joinedload(ForumThread.user))\
+        .filter(ForumThread.section_id == section_id)\
+        .order_by(ForumThread.timestamp.desc(), ForumThread.id.desc())\
+        .offset((page - 1) * per_page).limit(per_page).all()
+    return jsonify(
+        success=True,
+        threads=[{
+            'id': thread.id,
+            'title': thread.title,
+            'username': thread.user.username if thread.user else '',
+            'timestamp': thread.timestamp.isoformat() if thread.timestamp else None,
+            'reply_count': thread.reply_count or 0
+        } for thread in threads],
+        page=page,
+        pages=max(1, (total + per_page - 1) // per_page),
+        total=total
+    )
+
 @app.route('/api/admin/forum/sections/<int:section_id>', methods=['PUT'])
 @login_required
 def update_forum_section(section_id):
@@ -2212,10 +3879,10 @@ def delete_forum_section(section_id):
         if section.id == 1:  # 保护默认分区
             return jsonify(success=False, message="不能删除默认贴吧分区"), 400
         
-        # 删除分区下的帖子和回复
-        threads = db_session.query(ForumThread).filter_by(section_id=section_id).all()
-        for thread in threads:
-            db_session.query(ForumReply).filter_by(thread_id=thread.id).delete()
+        # 删除分区下的帖子和回复（按子查询批量删除回复，不逐帖加载）
+        thread_ids = select(ForumThread.id).where(ForumThread.section_id == section_id)
+        db_session.query(ForumReply).filter(ForumReply.thread_id.in_(thread_ids))\
+            .delete(synchronize_session=False)
         
         db_session.query(ForumThread).filter_by(section_id=section_id).delete()
         db_session.delete(section)
@@ -2245,6 +3912,8 @@ def delete_forum_post(post_id):
             if not reply:
                 return jsonify(success=False, message="帖子或回复不存在"), 404
             db_session.delete(reply)
+            db_session.flush()
+            refresh_thread_reply_stats([reply.thread_id])
             message = "删除了贴吧回复"
         
         db_session.commit()
@@ -2289,16 +3958,23 @@ def handle_connect():
     if not current_user.is_authenticated:
         return False  # 拒绝未认证用户
     
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db_session.commit()
+    # 加入个人频道，用于接收未读增量等定向推送
+    join_room(user_channel(current_user.id))
+    presence_connect(current_user.id, request.sid)
     
     session['receive_count'] = session.get('receive_count', 0) + 1
     emit('my_response', {'count': session['receive_count']})
 
+@socketio.on('disconnect')
+def handle_disconnect():
+    """连接断开：从在线状态服务中移除"""
+    presence_drop_sid(request.sid)
+    if current_user.is_authenticated:
+        presence_disconnect(current_user.id, request.sid)
+
 @socketio.on('join')
 def on_join(data):
-    """加入聊天室"""
+    """加入聊天室，并通知关注该用户的人"""
     if not current_user.is_authenticated:
         return
     
@@ -2317,20 +3993,16 @@ def on_join(data):
     
     room_name = f"room_{room_id}"
     join_room(room_name)
+    presence_join_room(room_id, request.sid, current_user)
     
-    # 更新在线状态
-    current_user.last_seen = datetime.utcnow()
-    db_session.commit()
+    # 更新在线状态（last_seen 进入缓冲，由后台批量写回）
+    presence_touch(current_user.id)
     
-    # 不再广播用户加入（取消进入聊天室的提示）
-    # emit('status', {
-    #     'msg': f'{current_user.nickname or current_user.username} 加入了聊天室',
-    #     'user_id': current_user.id
-    # }, room=room_name)
+    notify_followers('user_join', current_user, room_id)
 
 @socketio.on('leave')
 def on_leave(data):
-    """离开聊天室"""
+    """离开聊天室，并通知关注该用户的人"""
     if not current_user.is_authenticated:
         return
     
@@ -2345,12 +4017,9 @@ def on_leave(data):
     
     room_name = f"room_{room_id}"
     leave_room(room_name)
+    presence_leave_room(room_id, request.sid)
     
-    # 不再广播用户离开（取消离开聊天室的提示）
-    # emit('status', {
-    #     'msg': f'{current_user.nickname or current_user.username} 离开了聊天室',
-    #     'user_id': current_user.id
-    # }, room=room_name)
+    notify_followers('user_leave', current_user, room_id)
 
 @socketio.on('send_message')
 def handle_message(data):
@@ -2358,61 +4027,14 @@ def handle_message(data):
     if not current_user.is_authenticated:
         return
     
-    room_id = data.get('room_id')
-    content = data.get('message', '').strip()
-    
-    # 验证
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        room_id = None
-
-    if not room_id or not content:
-        emit('error', {'message': '参数错误'})
-        return
-
-    if not user_can_send_chat(current_user, room_id):
-        emit('error', {'message': '当前权限无法发送消息'})
-        return
-    
-    # 内容长度限制
-    if len(content) > 2000:
-        emit('error', {'message': '消息过长'})
-        return
-    
-    # XSS基础防护
-    content = sanitize_content(content)
-    
-    # 保存到数据库
-    message = ChatMessage(
-        content=content,  # 存储原始Markdown
-        user_id=current_user.id,
-        room_id=room_id
+    payload, error, status = send_chat_pipeline(
+        current_user, data.get('room_id'), data.get('message', ''), data.get('client_id')
     )
-    db_session.add(message)
-    db_session.commit()
-    
-    # 发送消息给房间内所有人（包括发送者），并携带 client_id（如果客户端发送了），
-    # 这样发送者可以收到带有服务器 id 的确认消息以更新本地 pending 消息
-    room_name = f"room_{room_id}"
-    client_id = data.get('client_id')
-    payload = {
-        'id': message.id,
-        'content': message.content,  # 原始Markdown
-        'timestamp': message.timestamp.isoformat(),
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'color': current_user.color,
-        'badge': current_user.badge
-    }
-
-    # 如果前端传来了 client_id，包含在payload中以便发送者进行匹配
-    if client_id:
-        payload['client_id'] = client_id
-
-    # include_self=True 使得发送者也能收到这条消息（用于将本地 pending 更新为服务器ID）
-    emit('message', payload, room=room_name, include_self=True)
+    if status == 429:
+        # 带回 client_id，便于客户端撤下对应的 pending 消息
+        emit('rate_limited', dict(payload, client_id=data.get('client_id')))
+    elif error:
+        emit('error', {'message': error})
 
 @socketio.on('get_online_users')
 def handle_get_online_users(data):
@@ -2445,13 +4067,11 @@ def handle_get_global_online_count(data):
     if not current_user.is_authenticated:
         return
     
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
+    # 客户端定期请求在线人数，同时视为心跳
+    presence_touch(current_user.id)
     
     # 发送全局在线人数到客户端
-    emit('global_online_count', {'count': online_count})
+    emit('global_online_count', {'count': presence_online_count()})
 
 
 # === 新增关注功能 API ===
@@ -2499,66 +4119,11 @@ def toggle_follow():
         action = "follow"
 
     db_session.commit()
+    follower_index_update(current_user.id, target_user.id, action == 'follow')
     log_admin_action(f"{current_user.username} {'关注' if action == 'follow' else '取消关注'} 用户 {target_user.username}")
     return jsonify(success=True, action=action)
 
 
-# 修改 on_join：广播用户进入
-@socketio.on('join')
-def on_join(data):
-    if not current_user.is_authenticated:
-        return
-    room_id = data.get('room')
-    if not room_id:
-        return
-
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        return
-
-    if not user_can_view_chat(current_user, room_id):
-        emit('permission_denied', {'message': '当前权限无法进入该聊天室', 'room_id': room_id})
-        return
-
-    room_name = f"room_{room_id}"
-    join_room(room_name)
-    current_user.last_seen = datetime.utcnow()
-    db_session.commit()
-    # 广播用户进入（供关注者监听）
-    emit('user_join', {
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'room_id': room_id
-    }, broadcast=True)
-
-
-# 修改 on_leave：广播用户离开
-@socketio.on('leave')
-def on_leave(data):
-    if not current_user.is_authenticated:
-        return
-    room_id = data.get('room')
-    if not room_id:
-        return
-
-    try:
-        room_id = int(room_id)
-    except (TypeError, ValueError):
-        return
-
-    room_name = f"room_{room_id}"
-    leave_room(room_name)
-    # 广播用户离开
-    emit('user_leave', {
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'nickname': current_user.nickname or current_user.username,
-        'room_id': room_id
-    }, broadcast=True)
-
-
 # 全局上下文处理器
 @app.context_processor
 def inject_user():
@@ -2567,13 +4132,8 @@ def inject_user():
 
 @app.context_processor
 def inject_online_count():
-    """注入在线用户数到模板"""
-    cutoff_time = datetime.utcnow() - timedelta(seconds=app.config.get('ONLINE_TIMEOUT', 300))
-    
-    # 查询最近活动的用户数
-    online_count = db_session.query(User).filter(User.last_seen >= cutoff_time).count()
-    
-    return dict(online_count=online_count)
+    """注入在线用户数到模板（来自在线状态服务，不查询数据库）"""
+    return dict(online_count=presence_online_count())
 
 # 错误处理
 @app.errorhandler(403)
@@ -2623,6 +4183,17 @@ def init_db():
     db_session.commit()
     log_admin_action("数据库初始化完成")
 
+def flush_buffers_on_exit():
+    """进程正常退出或被管理员重启/关停前写完聊天消息队列与 last_seen 缓冲"""
+    for name, flush in (('聊天消息队列', drain_chat_write_queue), ('last_seen', flush_last_seen)):
+        try:
+            flush()
+        except Exception:
+            logger.exception(f'退出前写回{name}失败')
+
+
+atexit.register(flush_buffers_on_exit)
+
 # 主程序
 if __name__ == '__main__':
     init_db()
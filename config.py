@@ -11,4 +11,30 @@ class Config:
     DEBUG = True  # 用于热重载
     SOCKETIO_ASYNC_MODE = 'eventlet'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB 上传限制
-    ONLINE_TIMEOUT = 300  # 5分钟无活动视为离线
\ No newline at end of file
+    ONLINE_TIMEOUT = 300  # 5分钟无活动视为离线
+    ONLINE_COUNT_CACHE_TTL = 10  # 在线人数数据库回退统计的缓存时间（秒）
+    PRESENCE_PUSH_INTERVAL = 2  # 在线名单变化合并推送间隔（秒）
+    LAST_SEEN_FLUSH_INTERVAL = 5  # last_seen 缓冲批量写回间隔（秒）
+    CHAT_WRITE_BEHIND = False  # 聊天消息写后队列：先广播后批量落盘，崩溃时可能丢失最近一个间隔内的消息
+    CHAT_WRITE_BEHIND_INTERVAL = 0.05  # 写后队列批量提交间隔（秒）
+    CHAT_WRITE_BEHIND_BATCH = 100  # 积压达到该条数时立即提交
+    # 发送限流令牌桶：(每秒补充令牌数, 桶容量)，设为 None 关闭对应限流
+    RATE_LIMITS = {
+        'chat_user': (1, 5),  # 每个用户发送聊天消息
+        'chat_room': (20, 40),  # 每个聊天室的消息总量
+        'forum_user': (0.2, 5),  # 每个用户发帖与回复
+        'forum_section': (2, 20),  # 每个分区的发帖与回复总量
+    }
+    RATE_LIMIT_OVERRIDES = {}  # 单独配置，如 {'chat_room': {1: (50, 100)}, 'chat_user': {2: None}}
+    RATE_LIMIT_STORE = None  # 共享限流存储 '模块:类名'（需实现 consume([(key, rate, burst)])），None 为进程内存
+    SERVER_RENDER = False  # 服务端预渲染 Markdown（需安装 markdown），消息附带 html 字段，客户端直接显示
+    RENDER_CACHE_SIZE = 2000  # 预渲染结果按内容哈希缓存的条数
+    STORE_RENDERED_HTML = False  # 把聊天消息的预渲染 HTML 保存到 chat_messages.content_html
+    UNREAD_PUSH_INTERVAL = 1  # 未读增量合并推送间隔（秒）
+    LONG_POLL_TIMEOUT = 25  # 长轮询最长挂起时间（秒）
+    SSE_KEEPALIVE_INTERVAL = 15  # SSE 心跳间隔（秒）
+    CHAT_CACHE_PER_ROOM = 200  # 每个聊天室在内存中缓存的最新消息数
+    CHAT_CACHE_MAX_MESSAGES = 20000  # 所有聊天室缓存消息总数上限，超出时淘汰最久未访问的房间
+    FORUM_THREADS_PER_PAGE = 20  # 贴吧分区每页主题数
+    FORUM_REPLIES_PER_PAGE = 50  # 帖子详情页每次加载的回复数
+    METRICS_REFRESH_INTERVAL = 60  # 管理面板统计指标刷新间隔（秒）
\ No newline at end of file
@@ -11,6 +11,9 @@ from ttkbootstrap.constants import *
 import requests
 from bs4 import BeautifulSoup
 import lxml
+import json
+import queue
+import threading
 from datetime import datetime
 
 class StellarsisClient:
@@ -24,6 +27,13 @@ class StellarsisClient:
         self.current_room_id = None
         self.current_section_id = None
         self.current_thread_id = None
+        self.chat_last_id = 0
+        
+        # SSE 实时消息流（后台线程读取，主线程通过队列更新界面）
+        self.chat_stream_response = None
+        self.chat_stream_queue = queue.Queue()
+        self.chat_stream_polling = False
+        self.chat_stream_stop = threading.Event()
         
         # 主题相关
         self.themes = [
@@ -311,6 +321,9 @@ class StellarsisClient:
         
         # 加载聊天历史
         self.load_chat_history()
+        
+        # 订阅该聊天室的实时消息流
+        self.start_chat_stream()
     
     def create_chat_room_interface(self, room_name, room_description):
         """创建聊天室界面"""
@@ -347,39 +360,146 @@ class StellarsisClient:
         self.message_entry.bind('<Return>', lambda e: self.send_chat_message())
     
     def load_chat_history(self):
-        """加载聊天历史"""
+        """加载聊天历史（最新一页）"""
         if not self.current_room_id:
             return
         
         try:
-            response = self.session.get(f"{self.base_url}/api/chat/{self.current_room_id}/history")
+            response = self.session.get(
+                f"{self.base_url}/api/chat/{self.current_room_id}/history",
+                params={'latest': 50}
+            )
             if response.status_code == 200:
                 data = response.json()
                 messages = data.get('messages', [])
+                # 重置追赶游标，之后只拉取更新的消息
+                self.chat_last_id = 0
                 
                 # 清除现有消息
                 self.chat_text.config(state=tk.NORMAL)
                 self.chat_text.delete(1.0, tk.END)
-                
-                # 添加消息
-                for msg in messages:
-                    timestamp = datetime.fromisoformat(msg['timestamp'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                    user_display = msg['nickname'] or msg['username']
-                    color = msg.get('color', '#000000')
-                    
-                    message_text = f"[{timestamp}] {user_display}: {msg['content']}\n"
-                    self.chat_text.insert(tk.END, message_text)
-                
-                # 设置为只读
                 self.chat_text.config(state=tk.DISABLED)
                 
-                # 滚动到底部
-                self.chat_text.see(tk.END)
+                self.append_chat_messages(messages)
             else:
                 messagebox.showerror("错误", f"加载聊天历史失败: {response.status_code}")
         except Exception as e:
             messagebox.showerror("错误", f"加载聊天历史时发生错误: {str(e)}")
     
+    def load_new_chat_messages(self):
+        """通过 after_id 游标只拉取上次之后的新消息"""
+        if not self.current_room_id:
+            return
+        
+        try:
+            response = self.session.get(
+                f"{self.base_url}/api/chat/{self.current_room_id}/history",
+                params={'after_id': self.chat_last_id, 'limit': 100}
+            )
+            if response.status_code == 200:
+                data = response.json()
+                self.append_chat_messages(data.get('messages', []))
+        except Exception as e:
+            messagebox.showerror("错误", f"加载新消息时发生错误: {str(e)}")
+    
+    def start_chat_stream(self):
+        """在后台线程中订阅当前聊天室的 SSE 消息流，断开后按指数退避重连并用 after_id 补齐"""
+        self.stop_chat_stream()
+        stop = self.chat_stream_stop = threading.Event()
+        room_id = self.current_room_id
+        url = f"{self.base_url}/api/chat/{room_id}/stream"
+        
+        def worker():
+            last_id = self.chat_last_id
+            delay = 1
+            while not stop.is_set() and self.current_room_id == room_id:
+                try:
+                    response = self.session.get(url, params={'after_id': max(last_id, self.chat_last_id)},
+                                                stream=True, timeout=(5, 60))
+                    if response.status_code in (403, 404):
+                        return  # 无权限或聊天室不存在，重连也没有意义
+                    if response.status_code == 200:
+                        self.chat_stream_response = response
+                        delay = 1
+                        data_lines = []
+                        for line in response.iter_lines(decode_unicode=True):
+                            if stop.is_set() or self.current_room_id != room_id:
+                                break
+                            if line is None:
+                                continue
+                            if line.startswith('data:'):
+                                data_lines.append(line[5:].strip())
+                            elif line == '' and data_lines:
+                                msg = json.loads('\n'.join(data_lines))
+                                last_id = max(last_id, msg.get('id', 0))
+                                self.chat_stream_queue.put((room_id, msg))
+                                data_lines = []
+                except Exception:
+                    pass  # 网络错误或服务器关闭连接，稍后重连
+                finally:
+                    if self.current_room_id == room_id:
+                        self.chat_stream_response = None
+                # 退避等待；切换房间或关闭界面时 stop 被设置，立即结束
+                if stop.wait(delay):
+                    return
+                delay = min(delay * 2, 30)
+        
+        threading.Thread(target=worker, daemon=True).start()
+        if not self.chat_stream_polling:
+            self.chat_stream_polling = True
+            self.root.after(200, self.poll_chat_stream)
+    
+    def stop_chat_stream(self):
+        """关闭正在读取的 SSE 连接并停止重连"""
+        self.chat_stream_stop.set()
+        response = self.chat_stream_response
+        self.chat_stream_response = None
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+    
+    def poll_chat_stream(self):
+        """在主线程中把后台线程收到的消息追加到界面"""
+        messages = []
+        while True:
+            try:
+                room_id, msg = self.chat_stream_queue.get_nowait()
+            except queue.Empty:
+                break
+            if room_id == self.current_room_id:
+                messages.append(msg)
+        try:
+            self.append_chat_messages(messages)
+        except tk.TclError:
+            # 聊天界面已关闭
+            self.chat_stream_polling = False
+            self.stop_chat_stream()
+            return
+        self.root.after(200, self.poll_chat_stream)
+    
+    def append_chat_messages(self, messages):
+        """把消息追加到聊天文本框末尾，跳过已显示的消息"""
+        messages = [msg for msg in messages if msg.get('id', 0) > self.chat_last_id]
+        if not messages:
+            return
+        self.chat_last_id = messages[-1]['id']
+        
+        self.chat_text.config(state=tk.NORMAL)
+        for msg in messages:
+            timestamp = datetime.fromisoformat(msg['timestamp'].replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
+            user_display = msg['nickname'] or msg['username']
+            
+            message_text = f"[{timestamp}] {user_display}: {msg['content']}\n"
+            self.chat_text.insert(tk.END, message_text)
+        
+        # 设置为只读
+        self.chat_text.config(state=tk.DISABLED)
+        
+        # 滚动到底部
+        self.chat_text.see(tk.END)
+    
     def send_chat_message(self):
         """发送聊天消息"""
         message = self.message_var.get().strip()
@@ -404,10 +524,14 @@ class StellarsisClient:
                 if data.get('success'):
                     # 清空输入框
                     self.message_var.set("")
-                    # 重新加载聊天历史以显示新消息
-                    self.load_chat_history()
+                    # 实时流可用时新消息会自动到达，否则只拉取新消息
+                    if not self.chat_stream_response:
+                        self.load_new_chat_messages()
                 else:
                     messagebox.showerror("错误", f"发送消息失败: {data.get('message', '未知错误')}")
+            elif response.status_code == 429:
+                # 发送过快被限流，保留输入框内容以便稍后重发
+                messagebox.showwarning("提示", response.json().get('message', '操作过于频繁，请稍后再试'))
             else:
                 messagebox.showerror("错误", f"发送消息失败: {response.status_code}")
         except Exception as e:
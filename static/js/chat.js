@@ -3,6 +3,8 @@ let chatSocket = null;
 let chatHistoryLoaded = false;
 let followedUserIds = new Set();  // 关注的用户ID集合
 let lastMessageId = 0;
+let historyPrevCursor = null;  // 向上翻页游标（before_id），为 null 表示没有更早的消息
+let loadingOlderMessages = false;
 let onlineUsers = [];
 let roomPermission = 'Null';
 
@@ -211,7 +213,7 @@ function waitForRenderSystem(callback) {
 function loadChatHistory() {
     if (chatHistoryLoaded) return;
 
-    fetch(`/api/chat/${roomId}/history`)
+    fetch(`/api/chat/${roomId}/history?latest=50`)
         .then(response => {
             if (!response.ok) {
                 throw new Error(`HTTP错误! 状态: ${response.status}`);
@@ -238,9 +240,12 @@ function loadChatHistory() {
                 }
             });
 
+            historyPrevCursor = data.prev;
+            setupHistoryScrollBack();
+
             // 更新最后一条消息ID
             if (data.messages.length > 0) {
-                lastMessageId = data.messages[data.messages.length - 1].id;
+                lastMessageId = data.next || data.messages[data.messages.length - 1].id;
                 // 设置最后消息日期为最后一条消息的日期
                 lastMessageDate = getMessageDate(data.messages[data.messages.length - 1].timestamp);
             }
@@ -261,92 +266,140 @@ function loadChatHistory() {
         });
 }
 
+// 滚动到顶部时加载更早的消息
+function setupHistoryScrollBack() {
+    const messagesContainer = document.getElementById('chat-messages');
+    if (!messagesContainer || messagesContainer.dataset.scrollBackBound) return;
+    messagesContainer.dataset.scrollBackBound = '1';
+    messagesContainer.addEventListener('scroll', function () {
+        if (messagesContainer.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
+}
+
+// 通过 before_id 游标加载更早的一页消息，并插入到列表顶部
+function loadOlderMessages() {
+    if (!historyPrevCursor || loadingOlderMessages) return;
+    loadingOlderMessages = true;
+
+    fetch(`/api/chat/${roomId}/history?before_id=${historyPrevCursor}&limit=50`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP错误! 状态: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            const messagesContainer = document.getElementById('chat-messages');
+            if (!messagesContainer) return;
+
+            // 保持当前可视位置不跳动
+            const previousHeight = messagesContainer.scrollHeight;
+            const firstChild = messagesContainer.firstChild;
+            data.messages.forEach(msg => {
+                if (msg.id && processedMessageIds.has(msg.id)) return;
+                const element = createMessageElement(msg, msg.user_id == userId);
+                messagesContainer.insertBefore(element, firstChild);
+                if (msg.id) processedMessageIds.add(msg.id);
+            });
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+
+            historyPrevCursor = data.prev;
+        })
+        .catch(error => {
+            console.error('加载更早的消息失败:', error);
+        })
+        .finally(() => {
+            loadingOlderMessages = false;
+        });
+}
+
 // 设置轮询（老旧浏览器降级方案）
+let pollingStarted = false;
+let pollingEtag = null;
+
 function setupPolling() {
+    // connect_error 可能多次触发，避免重复创建定时器
+    if (pollingStarted) return;
+    pollingStarted = true;
     console.log('使用轮询作为WebSocket的降级方案');
 
-    // 每5秒检查一次新消息
+    // 每5秒通过增量接口检查一次新消息；无变化时服务器返回 204/304，几乎没有开销
     setInterval(() => {
-        if (lastMessageId > 0) {
-            fetch(`/api/chat/${roomId}/history?offset=0&limit=50`)
-                .then(response => response.json())
-                .then(data => {
-                    const messagesContainer = document.getElementById('chat-messages');
-                    if (!messagesContainer) return;
-                    let hasNewMessages = false;
-                    data.messages.forEach(msg => {
-                        // skip if we've already processed this server id
-                        if (msg.id && processedMessageIds.has(msg.id)) return;
-
-                        // Try to match this server message to a pending local message
-                        let matched = false;
-                        const serverContent = msg.content || msg.message || '';
-                        const serverTsMs = msg.timestamp ? new Date(msg.timestamp).getTime() : Date.now();
-
-                        if (serverContent && pendingMessages.size > 0) {
-                            for (const [cid, pending] of pendingMessages.entries()) {
-                                try {
-                                    // Exact content match + reasonable time window (30s)
-                                    const pendingSent = pending.sentTime || pending.timestamp || 0;
-                                    // allow match when content equals and timestamps within 30s OR the calendar date matches (tolerate timezone differences)
-                                    const serverDateIso = new Date(serverTsMs).toISOString().slice(0,10);
-                                    const pendingDateIso = new Date(pendingSent).toISOString().slice(0,10);
-                                    if (pending.content === serverContent && (Math.abs(serverTsMs - pendingSent) < 30000 || serverDateIso === pendingDateIso)) {
-                                        console.debug('Polling matched pending by content/time (or same-date)', cid, '->', msg.id, 'serverDate=', serverDateIso, 'pendingDate=', pendingDateIso);
-                                        updateExistingMessage(cid, msg);
-                                        pendingMessages.delete(cid);
-                                        processedMessageIds.add(msg.id || cid);
-                                        matched = true;
-                                        break;
-                                    }
-
-                                    // Fallback: compare simplified content/time hash
-                                    const pendingHash = generateContentHash(pending.content || '', pending.timestamp || pending.sentTime || Date.now());
-                                    const serverHash = generateContentHash(serverContent, msg.timestamp || Date.now());
-                                    if (pendingHash === serverHash) {
-                                        console.debug('Polling matched pending by hash', cid, '->', msg.id);
-                                        updateExistingMessage(cid, msg);
-                                        pendingMessages.delete(cid);
-                                        processedMessageIds.add(msg.id || cid);
-                                        matched = true;
-                                        break;
-                                    }
-                                } catch (e) {
-                                    console.debug('Polling pending match error for', cid, e);
-                                }
-                            }
-                        }
-
-                        if (!matched) {
-                            // New message for UI
-                            addMessageToUI(msg, 0, 1);
-                            if (msg.id) processedMessageIds.add(msg.id);
-                            hasNewMessages = true;
-                        } else {
-                            // matched — still update lastMessageId if necessary
-                            hasNewMessages = true;
-                        }
+        if (!chatHistoryLoaded) return;
 
-                        // 更新最后一条消息ID
-                        if (msg.id && msg.id > lastMessageId) {
-                            lastMessageId = msg.id;
-                        }
-                    });
+        const headers = {};
+        if (pollingEtag) headers['If-None-Match'] = pollingEtag;
 
-                    if (hasNewMessages) {
-                        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        fetch(`/api/chat/${roomId}/updates?after_id=${lastMessageId || 0}`, { headers: headers })
+            .then(response => {
+                if (response.status === 204 || response.status === 304) {
+                    pollingEtag = response.headers.get('ETag') || pollingEtag;
+                    return null;
+                }
+                if (!response.ok) {
+                    throw new Error(`HTTP错误! 状态: ${response.status}`);
+                }
+                pollingEtag = response.headers.get('ETag');
+                return response.json();
+            })
+            .then(data => {
+                if (!data) return;
+                const messagesContainer = document.getElementById('chat-messages');
+                if (!messagesContainer) return;
+                let hasNewMessages = false;
+                data.messages.forEach(msg => {
+                    // skip if we've already processed this server id
+                    if (msg.id && processedMessageIds.has(msg.id)) return;
+
+                    if (!reconcilePendingMessage(msg)) {
+                        // New message for UI
+                        addMessageToUI(msg, 0, 1);
+                        if (msg.id) processedMessageIds.add(msg.id);
                     }
-                })
-                .catch(error => {
-                    console.error('轮询获取消息失败:', error);
+                    hasNewMessages = true;
                 });
-        }
+
+                if (data.next && data.next > lastMessageId) {
+                    lastMessageId = data.next;
+                }
+
+                if (hasNewMessages) {
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                }
+            })
+            .catch(error => {
+                console.error('轮询获取消息失败:', error);
+            });
     }, 5000);
 
     // 每30秒更新在线状态
     setInterval(updateOnlineStatus, 30000);
 }
 
+// 撤下未被服务器接受的 pending 消息，内容放回空输入框
+function dropPendingMessage(cid) {
+    if (!cid || !pendingMessages.has(cid)) return;
+    const pending = pendingMessages.get(cid);
+    pendingMessages.delete(cid);
+    const el = document.querySelector(`[data-message-id="${cid}"]`);
+    if (el) el.remove();
+    const messageInput = document.getElementById('message-text');
+    if (messageInput && !messageInput.value) messageInput.value = pending.content;
+}
+
+// 按服务器回传的 client_id 把本地 pending 消息更新为服务器消息（O(1) 查找），匹配成功返回 true
+function reconcilePendingMessage(msg) {
+    const cid = msg.client_id;
+    if (!cid || Number(msg.user_id) !== Number(currentUserId) || !pendingMessages.has(cid)) return false;
+    console.debug('Reconciled pending', cid, '->', msg.id);
+    updateExistingMessage(cid, msg);
+    pendingMessages.delete(cid);
+    processedMessageIds.add(msg.id || cid);
+    return true;
+}
+
 // 设置WebSocket
 function setupWebSocket() {
     // 检查WebSocket支持
@@ -428,41 +481,15 @@ function setupWebSocket() {
             addStatusMessage(payload.message || '当前权限不足，无法完成该操作');
         });
 
-        chatSocket.on('message', (data) => {
-            let handled = false;
-            if (data.id && pendingMessages.size > 0) {
-                const serverContent = data.content || data.message || '';
-                if (serverContent) {
-                    let matchedClientId = null;
-                    for (const [cid, pending] of pendingMessages.entries()) {
-                        try {
-                            console.debug('检查 pending:', cid, 'content=', pending.content, 'sentTime=', pending.sentTime, 'serverContent=', serverContent, 'serverTimestamp=', data.timestamp);
-                            // 精确内容+时间匹配（优先）
-                            if (pending.content === serverContent) {
-                                const serverTime = data.timestamp ? new Date(data.timestamp).getTime() : 0;
-                                const sentTime = pending.sentTime || 0;
-                                const serverDateIso = serverTime ? new Date(serverTime).toISOString().slice(0,10) : '';
-                                const pendingDateIso = sentTime ? new Date(sentTime).toISOString().slice(0,10) : '';
-                                if (!serverTime || Math.abs(serverTime - sentTime) < 15000 || (serverDateIso && pendingDateIso && serverDateIso === pendingDateIso)) {
-                                    matchedClientId = cid;
-                                    console.debug('精确匹配通过:', cid, 'serverDate=', serverDateIso, 'pendingDate=', pendingDateIso);
-                                    break;
-                                }
-                            }
-                        } catch (err) {
-                            console.debug('pending match check failed for', cid, err);
-                        }
-                    }
+        // 发送被限流：撤下对应的本地预览，并把内容放回输入框以便稍后重发
+        chatSocket.on('rate_limited', (payload = {}) => {
+            console.warn('发送被限流:', payload);
+            dropPendingMessage(payload.client_id);
+            addStatusMessage(payload.message || '操作过于频繁，请稍后再试');
+        });
 
-                    if (matchedClientId) {
-                        console.debug('Matched pending message by content/time/hash to client_id=', matchedClientId, 'server id=', data.id);
-                        updateExistingMessage(matchedClientId, data);
-                        pendingMessages.delete(matchedClientId);
-                        if (data.id) processedMessageIds.add(data.id); else processedMessageIds.add(matchedClientId);
-                        handled = true;
-                    }
-                }
-            }
+        chatSocket.on('message', (data) => {
+            const handled = reconcilePendingMessage(data);
             // 简单去重：如果已经处理过相同的服务器消息ID，则忽略
             if (data.id && processedMessageIds.has(data.id)) {
                 console.debug('忽略重复的服务器消息:', data.id);
@@ -490,7 +517,18 @@ function setupWebSocket() {
             updateOnlineCount();
         });
 
-        // 监听用户进出事件（用于关注通知） - 使用 addMessageToUI 以利用已存在的系统事件去重逻辑
+        // 服务器按间隔合并推送的名单变化，连接建立时取一次完整名单后只需应用增量
+        chatSocket.on('presence_diff', (data) => {
+            if (!data || Number(data.room_id) !== Number(roomId)) return;
+            const left = new Set(data.left || []);
+            const joined = data.joined || [];
+            const joinedIds = new Set(joined.map(user => user.id));
+            onlineUsers = onlineUsers.filter(user => !left.has(user.id) && !joinedIds.has(user.id)).concat(joined);
+            updateOnlineCount();
+            updateOnlineUsersList();
+        });
+
+        // 监听关注用户的进出事件（服务器只推送给关注者） - 使用 addMessageToUI 以利用已存在的系统事件去重逻辑
         chatSocket.on('user_join', (data) => {
             const msg = {
                 type: 'join',
@@ -500,9 +538,7 @@ function setupWebSocket() {
                 timestamp: data.timestamp || new Date().toISOString(),
                 content: ''
             };
-            if (followedUserIds.has(data.user_id)) {
-                addMessageToUI(msg);
-            }
+            addMessageToUI(msg);
         });
 
         chatSocket.on('user_leave', (data) => {
@@ -514,9 +550,7 @@ function setupWebSocket() {
                 timestamp: data.timestamp || new Date().toISOString(),
                 content: ''
             };
-            if (followedUserIds.has(data.user_id)) {
-                addMessageToUI(msg);
-            }
+            addMessageToUI(msg);
         });
     } catch (e) {
         console.error('WebSocket初始化失败:', e);
@@ -676,30 +710,30 @@ function sendMessage() {
             },
             body: JSON.stringify({
                 room_id: roomId,
-                message: message
+                message: message,
+                client_id: clientId
             })
         })
             .then(response => {
+                if (response.status === 429) {
+                    return response.json().then(data => {
+                        dropPendingMessage(clientId);
+                        addStatusMessage(data.message || '操作过于频繁，请稍后再试');
+                        return null;
+                    });
+                }
                 if (!response.ok) {
                     throw new Error('发送消息失败');
                 }
                 return response.json();
             })
             .then(data => {
-                if (data.success) {
-                    // 消息发送成功后，添加到UI
-                    const sentMessage = {
-                        id: 'sent-' + Date.now(),
-                        content: message,
-                        timestamp: new Date().toISOString(),
-                        user_id: currentUserId,
-                        username: currentUsername,
-                        nickname: currentNickname,
-                        color: currentUserColor,
-                        badge: currentUserBadge
-                    };
-
-                    addMessageToUI(sentMessage, true);
+                if (data && data.success) {
+                    // 服务器返回完整消息（含 id），后续轮询到同一条消息时会被去重
+                    pendingMessages.delete(clientId);
+                    if (data.id && processedMessageIds.has(data.id)) return;
+                    addMessageToUI(data, true);
+                    if (data.id) processedMessageIds.add(data.id);
                 }
             })
             .catch(error => {
@@ -985,7 +1019,9 @@ function updateExistingMessage(clientId, serverMessage) {
         if (contentElement) {
             contentElement.dataset.originalContent = serverMessage.content || serverMessage.message || contentElement.dataset.originalContent || '';
             try {
-                if (typeof window.renderContent === 'function') {
+                if (serverMessage.html) {
+                    showRenderedHtml(contentElement, serverMessage.html);
+                } else if (typeof window.renderContent === 'function') {
                     contentElement.innerHTML = window.renderContent(contentElement.dataset.originalContent);
                 } else {
                     contentElement.innerHTML = `<div class="render-fallback">${escapeHtml(contentElement.dataset.originalContent)}</div>`;
@@ -1168,8 +1204,12 @@ function createMessageElement(msg, isLocal = false) {
     contentElement.className = 'message-content';
     contentElement.dataset.originalContent = msg.content; // 保存原始内容用于重试
 
-    // 尝试立即渲染
-    tryRenderMessage(contentElement, msg.content);
+    // 服务端已预渲染时直接显示，否则在客户端渲染
+    if (msg.html) {
+        showRenderedHtml(contentElement, msg.html);
+    } else {
+        tryRenderMessage(contentElement, msg.content);
+    }
 
     // 组装
     messageElement.appendChild(userElement);
@@ -1219,6 +1259,13 @@ function processMessageQueue() {
     messageQueue = [];
 }
 
+// 显示服务端预渲染的 HTML（已过滤），只需排版其中的公式
+function showRenderedHtml(element, html) {
+    element.innerHTML = html;
+    element.dataset.serverRendered = '1';
+    if (typeof window.renderMath === 'function') window.renderMath(element);
+}
+
 // 安全渲染消息
 function tryRenderMessage(element, content) {
     if (typeof window.renderContent === 'function') {
@@ -1239,7 +1286,7 @@ function tryRenderMessage(element, content) {
 function retryRenderingAllMessages() {
     document.querySelectorAll('.message-content').forEach(element => {
         const content = element.dataset.originalContent;
-        if (content) {
+        if (content && !element.dataset.serverRendered) {
             tryRenderMessage(element, content);
         }
     });
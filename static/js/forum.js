@@ -2,7 +2,6 @@
 document.addEventListener('DOMContentLoaded', function() {
     // 检查是否在帖子页面
     const threadContent = document.querySelector('.thread-content');
-    const replyForm = document.getElementById('reply-form');
     
     // 如果是帖子详情页，处理内容渲染
     if (threadContent) {
@@ -12,9 +11,10 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // 如果是回复表单，设置提交处理
-    if (replyForm) {
-        setupReplyForm();
+    // 回复表单的提交由帖子页模板处理，这里只负责回复分页加载
+    const repliesContainer = document.querySelector('.replies[data-thread-id]');
+    if (repliesContainer) {
+        setupReplyPagination(repliesContainer);
     }
     
     // 处理所有回复内容
@@ -38,74 +38,86 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
-    // 设置回复表单
-    function setupReplyForm() {
-        const submitButton = replyForm.querySelector('button[type="submit"]');
-        const contentInput = replyForm.querySelector('textarea[name="content"]');
-        
-        if (!submitButton || !contentInput) return;
-        
-        submitButton.addEventListener('click', function(e) {
-            e.preventDefault();
-            
-            const content = contentInput.value.trim();
-            if (!content) {
-                showToast('warning', '回复内容不能为空');
-                return;
-            }
-            
-            // 禁用按钮，防止重复提交
-            submitButton.disabled = true;
-            submitButton.textContent = '提交中...';
-            
-            // 发送请求
-            const formData = new FormData();
-            formData.append('thread_id', replyForm.getAttribute('data-thread-id'));
-            formData.append('content', content);
-            
-            fetch('/api/forum/reply', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('网络响应不正常');
-                }
-                return response.json();
-            })
-            .then(data => {
-                if (data.success) {
-                    // 创建新的回复元素
-                    const repliesContainer = document.querySelector('.replies');
-                    if (repliesContainer) {
-                        const newReply = createReplyElement(data);
-                        repliesContainer.appendChild(newReply);
-                        
-                        // 滚动到新回复
-                        newReply.scrollIntoView({behavior: 'smooth'});
+    // 回复分页：向后按 after_id 滚动加载，向前按 before_id 加载更早回复
+    function setupReplyPagination(container) {
+        const threadId = container.dataset.threadId;
+        let prevCursor = container.dataset.prevCursor;
+        let nextCursor = container.dataset.nextCursor;
+        let loading = false;
+
+        function fetchReplies(params) {
+            loading = true;
+            return fetch(`/api/forum/thread/${threadId}/replies?${params}`, { credentials: 'same-origin' })
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('网络响应不正常');
                     }
-                    
-                    // 重置表单
-                    contentInput.value = '';
-                    submitButton.disabled = false;
-                    submitButton.textContent = '回复';
-                } else {
-                    throw new Error(data.message || '提交失败');
-                }
-            })
-            .catch(error => {
-                console.error('提交回复失败:', error);
-                showToast('error', '提交失败: ' + error.message);
-                submitButton.disabled = false;
-                submitButton.textContent = '回复';
+                    return response.json();
+                })
+                .finally(() => { loading = false; });
+        }
+
+        const moreButton = container.querySelector('.load-more-replies');
+        if (moreButton) {
+            const loadMore = function() {
+                if (loading || !nextCursor) return;
+                fetchReplies(`after_id=${nextCursor}`)
+                    .then(data => {
+                        data.replies.forEach(reply => {
+                            if (!document.getElementById(`reply-${reply.id}`)) {
+                                container.insertBefore(createReplyElement(reply), moreButton);
+                            }
+                        });
+                        nextCursor = data.next;
+                        if (!nextCursor) {
+                            moreButton.remove();
+                            if (observer) observer.disconnect();
+                        }
+                    })
+                    .catch(error => {
+                        console.error('加载回复失败:', error);
+                        showToast('error', '加载回复失败');
+                    });
+            };
+            moreButton.addEventListener('click', loadMore);
+            // 按钮滚动进入视口时自动加载
+            const observer = 'IntersectionObserver' in window ? new IntersectionObserver(entries => {
+                if (entries.some(entry => entry.isIntersecting)) loadMore();
+            }, { rootMargin: '200px' }) : null;
+            if (observer) observer.observe(moreButton);
+        }
+
+        const earlierButton = container.querySelector('.load-earlier-replies');
+        if (earlierButton) {
+            earlierButton.addEventListener('click', function() {
+                if (loading || !prevCursor) return;
+                fetchReplies(`before_id=${prevCursor}`)
+                    .then(data => {
+                        // 保持当前阅读位置，避免插入内容后页面跳动
+                        const anchor = earlierButton.nextElementSibling;
+                        const offset = anchor ? anchor.getBoundingClientRect().top : 0;
+                        data.replies.forEach(reply => {
+                            if (!document.getElementById(`reply-${reply.id}`)) {
+                                container.insertBefore(createReplyElement(reply), anchor);
+                            }
+                        });
+                        if (anchor) window.scrollBy(0, anchor.getBoundingClientRect().top - offset);
+                        prevCursor = data.prev;
+                        if (!prevCursor) earlierButton.remove();
+                    })
+                    .catch(error => {
+                        console.error('加载回复失败:', error);
+                        showToast('error', '加载回复失败');
+                    });
             });
-        });
+        }
     }
     
-    // 创建回复元素
+    // 创建回复元素（结构与帖子页模板一致，便于渲染库就绪后统一重新渲染）
     function createReplyElement(replyData) {
         const replyElement = document.createElement('div');
         replyElement.className = 'reply';
+        replyElement.id = `reply-${replyData.id}`;
         
         // 用户信息
         const userElement = document.createElement('div');
@@ -131,19 +143,44 @@ document.addEventListener('DOMContentLoaded', function() {
         timeElement.textContent = date.toLocaleString();
         userElement.appendChild(timeElement);
         
-        // 回复内容
+        if (replyData.can_delete) {
+            const deleteButton = document.createElement('button');
+            deleteButton.className = 'btn delete-btn';
+            deleteButton.textContent = '删除';
+            deleteButton.addEventListener('click', function() {
+                if (typeof window.deleteReply === 'function') {
+                    window.deleteReply(replyData.id, replyData.username);
+                }
+            });
+            userElement.appendChild(deleteButton);
+        }
+        
+        // 回复内容：保留原始内容，供渲染库就绪后重新渲染
         const contentElement = document.createElement('div');
         contentElement.className = 'reply-content';
+        const rawElement = document.createElement('script');
+        rawElement.type = 'application/json';
+        rawElement.className = 'raw-content';
+        rawElement.textContent = JSON.stringify(replyData.content || '');
+        const renderedElement = document.createElement('div');
+        renderedElement.className = 'rendered-content';
+        contentElement.appendChild(rawElement);
+        contentElement.appendChild(renderedElement);
         
-        // 等待渲染系统就绪
-        waitForRenderReady(function() {
-            try {
-                contentElement.innerHTML = window.renderContent(replyData.content);
-            } catch (e) {
-                console.error('回复渲染失败:', e);
-                contentElement.innerHTML = '<div class="render-error">' + escapeHtml(replyData.content) + '</div>';
-            }
-        });
+        // 服务端已预渲染时直接显示，否则等待渲染系统就绪
+        if (replyData.html) {
+            renderedElement.innerHTML = replyData.html;
+            if (typeof window.renderMath === 'function') window.renderMath(renderedElement);
+        } else {
+            waitForRenderReady(function() {
+                try {
+                    renderedElement.innerHTML = window.renderContent(replyData.content);
+                } catch (e) {
+                    console.error('回复渲染失败:', e);
+                    renderedElement.innerHTML = '<div class="render-error">' + escapeHtml(replyData.content) + '</div>';
+                }
+            });
+        }
         
         // 组装
         replyElement.appendChild(userElement);